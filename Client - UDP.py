@@ -4,264 +4,632 @@ import os
 import threading
 import time
 import hashlib
+import zlib
+import json
+import random
 import shutil
 import sys
+import argparse
 
+from client_common import (
+    JOURNAL_SUFFIX, PROGRESS_FORMAT, preallocate, write_at, merkle_root, missing_ranges,
+    RangeJournal, TokenBucket, ProgressReporter, follow_input_file, serve_control_socket,
+)
 
-HOST = input("Enter HOST IP: ")
-PORT_NUM = int(input("Port: "))
-ADDRESS = (HOST, PORT_NUM)
+
+# Defaults when not given on the command line
+HOST = "127.0.0.1"
+PORT_NUM = 8080
 ENCODING = "utf-8"
 BASE_DIRECTORY = os.path.dirname(__file__)
 INPUT_FILE = os.path.join(BASE_DIRECTORY, "input.txt")
 OUTPUT_DIRECTORY = os.path.join(BASE_DIRECTORY, "output")
 
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 1024  # payload of a data packet if the server can't be probed
+RECEIVE_BUFFER = 4 * 1024 * 1024  # socket receive buffer, room for the server's congestion window
+
+# Check each downloaded file against the server's manifest and fetch bad blocks again
+VERIFY_DOWNLOADS = True
+MAX_REPAIR_ROUNDS = 3
+MANIFEST_HEADER = struct.Struct("!QdIII")  # size, mtime, block size, block count, first block
+
+# Per-packet integrity asked of the server: "crc32", "sha256", or "none", which is only
+# used when downloads are verified against the manifest afterwards
+PACKET_INTEGRITY = "crc32"
+PACKET_HEADER = struct.Struct("!QB")  # seq, integrity mode, then the digest and the payload
+INTEGRITY_MODES = {"none": 0, "crc32": 1, "sha256": 2}
+DIGEST_SIZES = {0: 0, 1: 4, 2: 32}
+
+# The payload size is the largest datagram that reaches us from the server, found by
+# asking it for PROBE datagrams of these sizes (loopback, jumbo frames, Ethernet, IPv6 minimum)
+PROBE_SIZES = [65507, 16384, 8972, 1472, 1232]
+PROBE_TIMEOUT = 0.5
+PROBE_HEADER = struct.Struct("!5sI")  # b"PROBE", datagram size
+MAX_PAYLOAD = 65507 - PACKET_HEADER.size - 32
+
+# Received chunks are acknowledged in batches: a cumulative ACK plus a bitmap of the
+# chunks received after it, sent every ACK_EVERY packets or ACK_INTERVAL seconds after
+# the first packet it covers, whichever comes first
+ACK_EVERY = 16
+ACK_INTERVAL = 0.01
+SACK_WINDOW = 8192  # chunks after the cumulative ACK covered by the bitmap, the server's MAX_WINDOW
+ACK_HEADER = struct.Struct("!2sIQHH")  # magic, transfer id, cumulative, name length, bitmap length
+ACK_MAGIC = b"\x00A"
+RESEND_TIMEOUT = 2.0  # seconds without data before the missing chunks are asked for again
+
+# Several files are downloaded at once, sharing a thread and bandwidth budget
+MAX_ACTIVE_FILES = 3  # large files downloaded at the same time
+MAX_DOWNLOAD_THREADS = 8  # receiving threads over all downloads
+SMALL_FILE = 64 * BUFFER_SIZE  # files up to this size are downloaded one after another in a batch
+SMALL_BATCH = 16  # small files per batch, a batch runs next to the large files
+DOWNLOAD_ORDER = "shortest"  # "shortest" file first, or "input" for the order of input.txt
+MAX_DOWNLOAD_RATE = 0  # bytes/s over all downloads, 0 for unlimited
+RATE_STEP = 256 * 1024  # with a rate limit, chunks are requested this many bytes at a time
+
+# Files can also be requested, one name per line, over the local unix socket
+# CONTROL_SOCKET (e.g. with `nc -U`)
+CONTROL_SOCKET = os.path.join(BASE_DIRECTORY, "client-udp.sock")
 
 thread_lock = threading.Lock()
 files_pending = []
 files_downloaded = set()
 
-if not os.path.exists(OUTPUT_DIRECTORY):
-    os.makedirs(OUTPUT_DIRECTORY)
-if not os.path.exists(INPUT_FILE):
-        with open(INPUT_FILE, "w") as file:
-            file.write("")
+class FileDownload:
+    """A file queued for download from `client`'s server into `output_directory`, with its size and mtime on the server."""
+    def __init__(self, client, file_name, size, mtime, position, output_directory):
+        self.client = client
+        self.filename = file_name
+        self.path = os.path.join(output_directory, file_name)
+        self.size = size
+        self.mtime = mtime
+        self.position = position  # order in which it was requested
+        self.skipped = 0  # bytes already on disk when the download started
+        self.started = None
+        self.finished = None
+        self.status = "waiting"
+        self.transfer_id = random.getrandbits(32)  # names this download's sessions on the server
+        self.counters = []  # one per receiving thread
+
+    def add_counter(self):
+        counter = WorkerCounter()
+        self.counters.append(counter)
+        return counter
+
+    def done(self):
+        """Bytes on disk. Only reads counters that each thread updates on its own."""
+        return self.skipped + sum(counter.bytes for counter in self.counters)
+
+    def stats(self):
+        """Outcome of the download: status, bytes transferred, time taken and average rate."""
+        seconds = (self.finished or time.monotonic()) - self.started if self.started else 0.0
+        transferred = self.done() - self.skipped
+        return {"status": self.status, "size": self.size, "bytes": transferred, "resumed_from": self.skipped,
+                "seconds": round(seconds, 3), "rate": round(transferred / seconds) if seconds > 0 else 0}
+
+class WorkerCounter:
+    """Bytes received by one thread, written only by that thread."""
+    __slots__ = ("bytes",)
+
+    def __init__(self):
+        self.bytes = 0
 
 def compute_checksum(data):
     return hashlib.sha256(data).digest()
 
-def watch_input_file():
-    while True:
-        if os.path.exists(INPUT_FILE):
-            with open(INPUT_FILE, "r") as file:
-                seen = set()
-                lines = []
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        # Tách tên file và dung lượng
-                        file_name = line.split()[0]  # Lấy phần tử đầu tiên là tên file
-                        if file_name not in seen:
-                            lines.append(file_name)
-                            seen.add(file_name)
-            with thread_lock:
-                new_requests = [line for line in lines if line not in files_downloaded and line not in files_pending]
-                files_pending.extend(new_requests)
-
-        time.sleep(5)
-
-
-
-def combine_parts(partial_files, final_file_path):
+def packet_digest(mode, data):
+    """Digest of a packet payload for an integrity mode: nothing, CRC32 or SHA-256."""
+    if mode == INTEGRITY_MODES["crc32"]:
+        return struct.pack("!I", zlib.crc32(data))
+    if mode == INTEGRITY_MODES["sha256"]:
+        return hashlib.sha256(data).digest()
+    return b""
+
+def negotiated_integrity(integrity):
+    """The integrity mode to ask for: "none" only if downloads are verified afterwards."""
+    if integrity not in INTEGRITY_MODES or (integrity == "none" and not VERIFY_DOWNLOADS):
+        return "crc32"
+    return integrity
+
+def request_manifest(server_address, file_name, page_size=BUFFER_SIZE):
+    """Fetch all pages of a file's manifest, each at most `page_size` bytes. Returns (size, block size, hashes) or None."""
+    hashes = []
+    root = None
     try:
-        with open(final_file_path, 'wb') as final_file:
-            for partial_file in partial_files:
-                try:
-                    with open(partial_file, 'rb') as part:
-                        shutil.copyfileobj(part, final_file, BUFFER_SIZE)
-                except FileNotFoundError:
-                    print(f"Part file not found: {partial_file}")
-                except Exception as e:
-                    print(f" Error reading part file {partial_file}: {e}")
-        print(f"\nCombined all parts into {final_file_path}")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_sock:
+            client_sock.settimeout(2.0)
+            while root is None or len(hashes) < count:
+                for _ in range(3):
+                    client_sock.sendto(f"MANIFEST:{file_name}:{len(hashes)}:{page_size}".encode(), server_address)
+                    try:
+                        reply, _ = client_sock.recvfrom(65535)
+                        break
+                    except socket.timeout:
+                        continue
+                else:
+                    print(f"Error: No manifest received for {file_name}")
+                    return None
+                if reply.startswith(b"ERROR"):
+                    print(f"Error {reply.decode()}")
+                    return None
+                size, _, block_size, count, first = MANIFEST_HEADER.unpack_from(reply)
+                if first != len(hashes):
+                    continue  # late reply to an earlier request
+                start = MANIFEST_HEADER.size
+                root = reply[start:start + 32]
+                page = reply[start + 32:]
+                hashes.extend(page[i:i + 32] for i in range(0, len(page), 32))
     except Exception as e:
-        print(f"Failed to create final file {final_file_path}: {e}")
-
-def receive_file_chunks(server_address, file_name, start_chunk, end_chunk, output_file, bytes_remaining, part_index, stop_signal, progress_tracker, thread_lock):
-    total_bytes = min(bytes_remaining, (end_chunk - start_chunk + 1) * BUFFER_SIZE)
-    bytes_received = 0
+        print(f"Error Failed to retrieve manifest: {e}")
+        return None
+    if merkle_root(hashes) != root:
+        print(f"Error: Manifest of {file_name} does not match its Merkle root")
+        return None
+    return size, block_size, hashes
+
+def find_bad_blocks(file_path, block_size, hashes):
+    bad = []
+    with open(file_path, 'rb') as file:
+        for index, expected in enumerate(hashes):
+            if compute_checksum(file.read(block_size)) != expected:
+                bad.append(index)
+    return bad
+
+def verify_download(server_address, file_name, final_file_path, stop_signal, chunk_size=BUFFER_SIZE):
+    """Check a downloaded file against its manifest and fetch bad blocks again."""
+    manifest = request_manifest(server_address, file_name, chunk_size)
+    if manifest is None:
+        return False
+    size, block_size, hashes = manifest
+
+    for _ in range(MAX_REPAIR_ROUNDS):
+        bad = find_bad_blocks(final_file_path, block_size, hashes)
+        if not bad:
+            print(f"\n{file_name} verified ({len(hashes)} blocks)")
+            return True
+        print(f"\n{file_name}: {len(bad)} corrupted block(s), downloading them again")
+        # A new transfer, the server would skip the chunks acknowledged in the last one.
+        # Blocks that arrived corrupted are fetched again with the strongest packet check.
+        transfer_id = random.getrandbits(32)
+        fd = os.open(final_file_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            for index in bad:
+                offset = index * block_size
+                start = offset // chunk_size
+                end = (min(offset + block_size, size) - 1) // chunk_size
+                receive_file_chunks(server_address, file_name, start, end, fd, stop_signal,
+                                    transfer_id=transfer_id, integrity="sha256", chunk_size=chunk_size, file_size=size)
+        finally:
+            os.close(fd)
+    print(f"\n{file_name} is still corrupted after {MAX_REPAIR_ROUNDS} attempts")
+    return False
+
+def queue_files(file_names):
+    """Add requested files to the pending list, skipping known ones. Returns the names added."""
+    with thread_lock:
+        new_requests = [file_name for file_name in dict.fromkeys(file_names)
+                        if file_name not in files_downloaded and file_name not in files_pending]
+        files_pending.extend(new_requests)
+    return new_requests
 
+def watch_input_file():
+    """Queue the files listed in input.txt as soon as they are added to it."""
+    # Tách tên file và dung lượng, lấy phần tử đầu tiên là tên file
+    follow_input_file(INPUT_FILE, lambda lines: queue_files(line.split()[0] for line in lines))
+
+def build_ack(file_name, transfer_id, cumulative, chunks_received, highest):
+    """Binary ACK of every chunk below `cumulative` and those in `chunks_received` after it."""
+    span = max(0, min(highest - cumulative, SACK_WINDOW))
+    bitmap = bytearray((span + 7) // 8)
+    for i in range(span):
+        if cumulative + 1 + i in chunks_received:
+            bitmap[i >> 3] |= 0x80 >> (i & 7)
+    name = file_name.encode(ENCODING)
+    header = ACK_HEADER.pack(ACK_MAGIC, transfer_id, cumulative, len(name), len(bitmap))
+    return header + name + bitmap
+
+def receive_file_chunks(server_address, file_name, start_chunk, end_chunk, output_fd, stop_signal, journal=None, counter=None,
+                        transfer_id=0, integrity=PACKET_INTEGRITY, chunk_size=BUFFER_SIZE, file_size=None):
+    """Receive chunks start_chunk..end_chunk of `chunk_size` bytes and write each one at its offset in `output_fd`.
+
+    Packets of another length than the chunk's, `file_size` taken from `output_fd` if not
+    given, are dropped: they were sent with another chunk size than the one negotiated.
+
+    Received chunks are recorded in `journal` and counted in `counter` if given. The
+    server keeps what was acknowledged per (socket, file, `transfer_id`) session, and
+    checks packets with the `integrity` mode, or SHA-256 if it does not allow that mode.
+    Chunks are acknowledged in batches, see ACK_EVERY and ACK_INTERVAL.
+    """
     if stop_signal.is_set():
         return
 
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_sock:
-            client_sock.settimeout(2.0)
+            client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
 
-            request_message = f"RANGE:{file_name}:{start_chunk}:{end_chunk}".encode()
+            integrity = negotiated_integrity(integrity)
+            accepted = {INTEGRITY_MODES[integrity], INTEGRITY_MODES["sha256"]}
+            request_message = f"RANGE:{file_name}:{start_chunk}:{end_chunk}:{transfer_id}:{integrity}:{chunk_size}".encode()
             client_sock.sendto(request_message, server_address)
+            if file_size is None:
+                file_size = os.fstat(output_fd).st_size
+
+            def resend(first, last):
+                message = f"RESEND:{file_name}:{first}:{last}:{transfer_id}:{integrity}:{chunk_size}".encode()
+                client_sock.sendto(message, server_address)
 
-            buffer = {}
             chunks_received = set()
             expected_chunks = set(range(start_chunk, end_chunk + 1))
+            cumulative = highest = start_chunk  # first chunk not received, last one received
+            unacked = 0  # packets since the last ACK
+            ack_due = None  # when the ACK of the first of them must be sent
+
+            def send_ack():
+                nonlocal cumulative, unacked, ack_due
+                while cumulative in chunks_received:
+                    cumulative += 1
+                client_sock.sendto(build_ack(file_name, transfer_id, cumulative, chunks_received, highest), server_address)
+                unacked = 0
+                ack_due = None
+
+            while chunks_received != expected_chunks:
+                if stop_signal.is_set():
+                    break
 
-            with open(output_file, 'wb') as part_file:
-                while chunks_received != expected_chunks:
-                    if stop_signal.is_set():
-                        break
-
-                    try:
-                        packet, _ = client_sock.recvfrom(1024 + BUFFER_SIZE)
-                        seq_num, = struct.unpack('I', packet[:4])
-                        checksum = packet[4:36]
-                        data = packet[36:]
-
-
-                        if compute_checksum(data) == checksum:
-                            if seq_num not in chunks_received:
-                                buffer[seq_num] = data
-                                chunks_received.add(seq_num)
-                                bytes_received += len(data)
-
-
-                                update_progress(progress_tracker, part_index, bytes_received, total_bytes, thread_lock)
-
-
-                                while start_chunk in buffer:
-                                    part_file.write(buffer.pop(start_chunk))
-                                    start_chunk += 1
-
-
-                                ack_message = f"ACK:{seq_num}".encode()
-                                client_sock.sendto(ack_message, server_address)
-                        else:
+                try:
+                    if ack_due is None:
+                        client_sock.settimeout(RESEND_TIMEOUT)
+                    else:
+                        client_sock.settimeout(max(ack_due - time.monotonic(), 0.0001))
+                    packet, _ = client_sock.recvfrom(PACKET_HEADER.size + 32 + chunk_size)
+                    seq_num, mode = PACKET_HEADER.unpack_from(packet)
+                    if mode not in accepted:
+                        continue
+                    digest_end = PACKET_HEADER.size + DIGEST_SIZES[mode]
+                    data = packet[digest_end:]
+                    if len(data) != min(chunk_size, file_size - seq_num * chunk_size):
+                        continue
+
+                    if packet_digest(mode, data) == packet[PACKET_HEADER.size:digest_end]:
+                        if seq_num in expected_chunks and seq_num not in chunks_received:
+                            # Chunks go straight to their place in the file, no reordering needed
+                            write_at(output_fd, data, seq_num * chunk_size)
+                            if journal:
+                                journal.record(seq_num * chunk_size, len(data))
+                            if counter:
+                                counter.bytes += len(data)
+                            chunks_received.add(seq_num)
+                            highest = max(highest, seq_num)
+                        # A duplicate was sent again because our ACK was lost, it is acknowledged too
+                        unacked += 1
+                        if ack_due is None:
+                            ack_due = time.monotonic() + ACK_INTERVAL
+                        if unacked >= ACK_EVERY:
+                            send_ack()
+                    else:
+                        resend(seq_num, seq_num)
 
-                            resend_message = f"RESEND:{file_name}:{seq_num}:{seq_num}".encode()
-                            client_sock.sendto(resend_message, server_address)
+                except socket.timeout:
+                    if ack_due is not None:
+                        send_ack()
+                        continue
 
-                    except socket.timeout:
+                    missing_chunks = expected_chunks - chunks_received
+                    if missing_chunks:
+                        resend(min(missing_chunks), max(missing_chunks))
 
-                        missing_chunks = expected_chunks - chunks_received
-                        if missing_chunks:
-                            resend_message = f"RESEND:{file_name}:{min(missing_chunks)}:{max(missing_chunks)}".encode()
-                            client_sock.sendto(resend_message, server_address)
+            if unacked:
+                # The server waits for the last chunks to be acknowledged, send it twice in case one is lost
+                send_ack()
+                send_ack()
 
     except Exception as e:
-        print(f"\nError in part {part_index + 1}: {e}")
-    finally:
-
-        if bytes_received == total_bytes:
-            with thread_lock:
-                progress_tracker[part_index] = 100
-
-
-def update_progress(progress_tracker, part_index, bytes_received, total_bytes, thread_lock):
-    percent_done = int((bytes_received / total_bytes) * 100)
-    with thread_lock:
-        progress_tracker[part_index] = percent_done
-
+        print(f"\nError receiving chunks {start_chunk}-{end_chunk} of {file_name}: {e}")
 
-        sys.stdout.write("\r")
-        sys.stdout.write(" | ".join(
-            [f"Part {i + 1}: {progress_tracker.get(i, 0)}%" for i in range(4)]
-        ))
-        sys.stdout.flush()
-
-def download_full_file(file_name, stop_signal):
+def download_full_file(download, stop_signal, slots=None):
+    """Download a file with up to 4 threads, each taking one of `slots` (the client's thread budget by default)."""
+    client = download.client
+    chunk_size = client.chunk_size
     try:
-
-        file_size = request_file_info(file_name)
-        if file_size is None:
+        file_name, file_size, mtime = download.filename, download.size, download.mtime
+        final_file_path = download.path
+        download.started = time.monotonic()
+        download.status = "downloading"
+        journal_path = final_file_path + JOURNAL_SUFFIX
+        done = RangeJournal.load(journal_path, file_size, mtime)
+        if done is not None and os.path.isfile(final_file_path) and os.path.getsize(final_file_path) == file_size:
+            output_fd = os.open(final_file_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+            missing = missing_ranges(done, file_size)
+            download.skipped = file_size - sum(end - start for start, end in missing)
+            print(f"\nResuming {file_name}: {download.skipped}/{file_size} bytes on disk")
+            runs = [(start // chunk_size, (end - 1) // chunk_size) for start, end in missing]
+        elif (done is None and not os.path.exists(journal_path) and os.path.isfile(final_file_path)
+              and (os.path.getsize(final_file_path), os.path.getmtime(final_file_path)) == (file_size, mtime)):
+            print(f"\n{file_name} is already up to date.")
+            download.status = "up to date"
+            download.finished = time.monotonic()
             return
-
-        if file_size == 0:
-            handle_empty_file(file_name)
+        else:
+            output_fd = preallocate(final_file_path, file_size)
+            done = None
+            runs = split_chunks(file_size, chunk_size) if file_size > SMALL_FILE else [(0, (file_size - 1) // chunk_size)]
+        journal = RangeJournal(journal_path, output_fd, file_size, mtime, done)
+
+        try:
+            thread_pool = setup_download_threads(download, output_fd, runs, journal, stop_signal,
+                                                 slots or client.download_slots)
+            wait_for_threads_to_complete(thread_pool)
+        finally:
+            complete = journal.complete()
+            if complete:
+                journal.remove()
+            else:
+                journal.close()
+            os.close(output_fd)
+            download.finished = time.monotonic()
+
+        if not complete:
+            print(f"\n{file_name} incomplete, will resume next time")
+            download.status = "incomplete"
             return
+        print(f"\n[SUCCESS] File {file_name} downloaded into {final_file_path}.")
+        download.status = "downloaded"
 
-
-        thread_pool, partial_files = setup_download_threads(file_name, file_size, stop_signal)
-
-
-        wait_for_threads_to_complete(thread_pool)
-
-        combine_and_cleanup(file_name, partial_files)
+        if VERIFY_DOWNLOADS and not verify_download(client.address, file_name, final_file_path, stop_signal, chunk_size):
+            # Left with its local mtime, so the next run downloads it again
+            download.status = "corrupted"
+            return
+        # The server's mtime marks the file as up to date once the journal is gone
+        os.utime(final_file_path, (time.time(), mtime))
+        print(f" {file_name} downloaded successfully.")
 
     except Exception as e:
         print(f"Error Failed to download file: {e}")
+        download.status = "error"
+
+def download_small_files(batch, stop_signal):
+    """Download a batch of small files one after another, next to the large downloads."""
+    for download in batch:
+        if stop_signal.is_set():
+            break
+        download_full_file(download, stop_signal, download.client.batch_slot)
+
+def start_downloads(waiting, active, stop_signal, max_active=MAX_ACTIVE_FILES):
+    """Start queued downloads while the budget allows: up to `max_active` large
+    files, plus one batch of small files so they don't wait behind large ones."""
+    if DOWNLOAD_ORDER == "shortest":
+        waiting.sort(key=lambda d: (d.size, d.position))
+    else:
+        waiting.sort(key=lambda d: d.position)
+
+    if not any(small for _, _, small in active):
+        batch = [d for d in waiting if d.size <= SMALL_FILE][:SMALL_BATCH]
+        if batch:
+            for download in batch:
+                waiting.remove(download)
+            thread = threading.Thread(target=download_small_files, args=(batch, stop_signal))
+            active.append((thread, batch, True))
+            thread.start()
+
+    large = [d for d in waiting if d.size > SMALL_FILE]
+    running = sum(1 for _, _, small in active if not small)
+    for download in large[:max(0, max_active - running)]:
+        waiting.remove(download)
+        thread = threading.Thread(target=download_full_file, args=(download, stop_signal))
+        active.append((thread, [download], False))
+        thread.start()
 
+def probe_payload_size(server_address):
+    """Largest data packet payload that reaches us from the server in one datagram.
 
-def request_file_info(file_name):
-
+    The server sends a PROBE datagram of each of PROBE_SIZES without fragmenting
+    them, so only the sizes the path carries arrive. BUFFER_SIZE if none does.
+    """
+    sizes = sorted(PROBE_SIZES, reverse=True)
+    largest = 0
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_sock:
-            client_sock.sendto(file_name.encode(), ADDRESS)
+            client_sock.settimeout(PROBE_TIMEOUT)
+            client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+            client_sock.sendto(f"PROBE:{','.join(map(str, sizes))}".encode(), server_address)
+            while largest < sizes[0]:
+                try:
+                    reply, _ = client_sock.recvfrom(65535)
+                except socket.timeout:
+                    break
+                if len(reply) >= PROBE_HEADER.size:
+                    magic, size = PROBE_HEADER.unpack_from(reply)
+                    if magic == b"PROBE" and size == len(reply):
+                        largest = max(largest, size)
+    except OSError as e:
+        print(f"Error Failed to probe the path MTU: {e}")
+    if largest <= PACKET_HEADER.size + 32:
+        return BUFFER_SIZE
+    return min(MAX_PAYLOAD, largest - PACKET_HEADER.size - 32)
+
+def request_file_stat(server_address, file_name):
+    """Return (size, mtime) of a file on the server, or None."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_sock:
+            client_sock.settimeout(2.0)
+            client_sock.sendto(f"STAT:{file_name}".encode(), server_address)
             file_info, _ = client_sock.recvfrom(1024)
 
         if file_info.startswith(b"ERROR"):
             print(f"Error {file_info.decode()}")
             return None
 
-        return int(file_info.decode())
+        size, mtime = file_info.decode().split(":")
+        return int(size), float(mtime)
     except Exception as e:
         print(f"Error Failed to retrieve file information: {e}")
         return None
 
-
 def handle_empty_file(file_name):
     print(f"File {file_name} is empty.")
     print(f"{file_name} downloaded successfully (empty file).")
 
-
-def setup_download_threads(file_name, file_size, stop_signal):
-
-    total_chunks = (file_size + BUFFER_SIZE - 1) // BUFFER_SIZE
+def split_chunks(file_size, chunk_size=BUFFER_SIZE):
+    """Split all chunks of a file into (start chunk, end chunk) runs, one per thread."""
+    total_chunks = (file_size + chunk_size - 1) // chunk_size
     thread_count = min(4, total_chunks)
     chunks_per_thread = total_chunks // thread_count
     extra_chunks = total_chunks % thread_count
 
-    thread_pool = []
-    partial_files = []
-    progress_tracker = {}
-    thread_lock = threading.Lock()
-
+    runs = []
     bytes_left = file_size
     for index in range(thread_count):
         start, end, bytes_per_thread = calculate_chunk_range(
-            index, chunks_per_thread, extra_chunks, bytes_left
+            index, chunks_per_thread, extra_chunks, bytes_left, chunk_size
         )
+        runs.append((start, end))
+        bytes_left -= bytes_per_thread
+    return runs
+
+def receive_chunk_runs(download, runs, output_fd, stop_signal, journal, slots, counter):
+    client = download.client
+    chunk_size = client.chunk_size
+    with slots:
+        for start, end in runs:
+            # Under a rate limit, request the chunks a few at a time
+            step = max(1, RATE_STEP // chunk_size) if client.bandwidth.rate else end - start + 1
+            for first in range(start, end + 1, step):
+                last = min(first + step - 1, end)
+                client.bandwidth.consume((last - first + 1) * chunk_size)
+                receive_file_chunks(client.address, download.filename, first, last, output_fd, stop_signal,
+                                    journal, counter, download.transfer_id, client.integrity, chunk_size, download.size)
+
+def setup_download_threads(download, output_fd, runs, journal, stop_signal, slots):
+    """Start up to 4 threads downloading the (start chunk, end chunk) runs."""
+    thread_count = min(4, len(runs))
+    thread_pool = []
 
-        part_file_path = os.path.join(OUTPUT_DIRECTORY, f"{file_name}.part{index + 1}")
-        partial_files.append(part_file_path)
-
+    for index in range(thread_count):
         thread = threading.Thread(
-            target=receive_file_chunks,
-            args=(ADDRESS,file_name,start,end,part_file_path,bytes_left,index,stop_signal,progress_tracker,thread_lock,),
+            target=receive_chunk_runs,
+            args=(download,runs[index::thread_count],output_fd,stop_signal,journal,slots,download.add_counter(),),
         )
 
-        bytes_left -= bytes_per_thread
         thread_pool.append(thread)
         thread.start()
 
-    return thread_pool, partial_files
+    return thread_pool
 
-
-def calculate_chunk_range(index, chunks_per_thread, extra_chunks, bytes_left):
+def calculate_chunk_range(index, chunks_per_thread, extra_chunks, bytes_left, chunk_size=BUFFER_SIZE):
     start = index * chunks_per_thread
     end = start + chunks_per_thread - 1
-    bytes_per_thread = min(bytes_left, chunks_per_thread * BUFFER_SIZE)
+    bytes_per_thread = min(bytes_left, chunks_per_thread * chunk_size)
 
     if index == 3:
         end += extra_chunks
-        bytes_per_thread = min(bytes_left, (chunks_per_thread + extra_chunks) * BUFFER_SIZE)
+        bytes_per_thread = min(bytes_left, (chunks_per_thread + extra_chunks) * chunk_size)
 
     return start, end, bytes_per_thread
 
-
 def wait_for_threads_to_complete(thread_pool):
     for thread in thread_pool:
         thread.join()
 
-
-def combine_and_cleanup(file_name, partial_files):
-    final_file_path = os.path.join(OUTPUT_DIRECTORY, file_name)
-    combine_parts(partial_files, final_file_path)
-    print(f"\n[SUCCESS] File {file_name} combined successfully.")
-
-    for part_file in partial_files:
-        os.remove(part_file)
-
-def client_main():
+class Downloader:
+    """Downloads files from one server; the interface for other programs.
+
+    Holds the server address and the thread and bandwidth budgets shared by
+    its downloads. Nothing is asked or created until download() is called.
+    """
+    def __init__(self, host=HOST, port=PORT_NUM, concurrency=MAX_ACTIVE_FILES, threads=MAX_DOWNLOAD_THREADS,
+                 max_rate=MAX_DOWNLOAD_RATE, progress="none", integrity=PACKET_INTEGRITY):
+        self.address = (host, port)
+        self.integrity = integrity  # per-packet check asked of the server
+        self.chunk_size = None  # data packet payload, probed on the first download
+        self.concurrency = concurrency  # large files downloaded at the same time
+        self.progress = progress  # PROGRESS_FORMAT shown while download() runs
+        self.download_slots = threading.BoundedSemaphore(threads)  # receiving threads over all downloads
+        self.batch_slot = threading.BoundedSemaphore(1)  # kept for small files, so they never wait behind large ones
+        self.bandwidth = TokenBucket(max_rate)
+
+    def probe(self):
+        """Find the payload size to ask the server for, once."""
+        if self.chunk_size is None:
+            self.chunk_size = probe_payload_size(self.address)
+        return self.chunk_size
+
+    def list_files(self):
+        """The server's file list, one "name size" line per file, or None if it does not answer."""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_sock:
+            client_sock.settimeout(2.0)
+            client_sock.sendto(b"[LIST]", self.address)
+            try:
+                return client_sock.recv(1024).decode(ENCODING)
+            except socket.timeout:
+                return None
+
+    def stat(self, file_name):
+        """(size, mtime) of a file on the server, or None."""
+        return request_file_stat(self.address, file_name)
+
+    def download(self, file_names, dest=OUTPUT_DIRECTORY, stop_signal=None):
+        """Download the files in `file_names` into `dest` and wait for them.
+
+        Returns {file name: stats} with the status ("downloaded", "up to date",
+        "incomplete", "corrupted" or "error"), bytes transferred, seconds and rate
+        of each file. Setting `stop_signal` stops the downloads, which resume on
+        the next call.
+        """
+        os.makedirs(dest, exist_ok=True)
+        stop_signal = stop_signal or threading.Event()
+        self.probe()
+        stats = {}
+        downloads = []
+        for position, file_name in enumerate(dict.fromkeys(file_names), 1):
+            file_stat = self.stat(file_name)
+            if file_stat is None:
+                stats[file_name] = {"status": "error", "error": f"no such file on the server: {file_name}"}
+                continue
+            download = FileDownload(self, file_name, file_stat[0], file_stat[1], position, dest)
+            if download.size == 0:
+                open(download.path, "wb").close()
+                os.utime(download.path, (time.time(), download.mtime))
+                download.started = download.finished = time.monotonic()
+                download.status = "downloaded"
+            downloads.append(download)
+
+        waiting = [download for download in downloads if download.status == "waiting"]
+        active = []  # (thread, FileDownloads, small batch) of running downloads
+        reporter_stop = threading.Event()
+        reporter = ProgressReporter(lambda: [download for _, batch, _ in active for download in batch], self.progress)
+        threading.Thread(target=reporter.run, args=(reporter_stop,), daemon=True).start()
+        try:
+            while (waiting and not stop_signal.is_set()) or active:
+                if not stop_signal.is_set():
+                    start_downloads(waiting, active, stop_signal, self.concurrency)
+                active[:] = [entry for entry in active if entry[0].is_alive()]
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            stop_signal.set()
+            # Let running downloads save their journals
+            for thread, _, _ in active:
+                thread.join()
+            raise
+        finally:
+            reporter_stop.set()
+
+        for download in downloads:
+            stats[download.filename] = download.stats()
+        return stats
+
+def client_main(client, output_directory=OUTPUT_DIRECTORY):
+    """Download the files added to input.txt or sent to the control socket until interrupted."""
     stop_signal = threading.Event()
+    active = []  # (thread, FileDownloads, small batch) of running downloads
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        request_message = "[LIST]"
-        client_socket.sendto(request_message.encode(), ADDRESS)
-
-        available_files_data = client_socket.recv(1024).decode(ENCODING)
+        os.makedirs(output_directory, exist_ok=True)
+        if not os.path.exists(INPUT_FILE):
+            with open(INPUT_FILE, "w") as file:
+                file.write("")
+        available_files_data = client.list_files()
         if not available_files_data:
             print("Error: Server did not respond with file list.")
             return
+        print(f"Using {client.probe()} byte packets")
 
         print("\nAvailable files:")
         available_files = available_files_data.split('\n')
@@ -273,14 +641,19 @@ def client_main():
 
         monitor_thread = threading.Thread(target=watch_input_file, daemon=True)
         monitor_thread.start()
+        threading.Thread(target=serve_control_socket, args=(CONTROL_SOCKET, queue_files), daemon=True).start()
+        reporter = ProgressReporter(lambda: [download for _, batch, _ in active for download in batch], client.progress)
+        threading.Thread(target=reporter.run, args=(stop_signal,), daemon=True).start()
 
-        displayed_files = set()
+        waiting = []  # FileDownloads not started yet
+        position = 0
         while not stop_signal.is_set():
             with thread_lock:
                 files_to_process = list(files_pending)
+                files_pending.clear()
+                files_downloaded.update(files_to_process)
 
-            if files_to_process and set(files_to_process) != displayed_files:
-                displayed_files = set(files_to_process)
+            if files_to_process:
                 terminal_width = shutil.get_terminal_size().columns
                 print("-" * terminal_width)
                 print("\n Files waiting for download:")
@@ -288,34 +661,84 @@ def client_main():
                     print(f"  {file_name}")
                 print("-" * terminal_width)
 
-            if files_to_process:
-                for file_name in files_to_process:
-                    with thread_lock:
-                        files_pending.remove(file_name)
-                        files_downloaded.add(file_name)
-                    if file_name in available_files:
-                        print(f"I NEED {file_name}\n")
-                        download_full_file(file_name, stop_signal)
-                        if not stop_signal.is_set():
-                            print(f" {file_name} downloaded successfully.")
-                            terminal_width = shutil.get_terminal_size().columns
-                            print("-" * terminal_width)
-                            print()
-                        else:
-                            break
-                    else:
-                        print(f"Error: File {file_name} not found on server.")
-                        terminal_width = shutil.get_terminal_size().columns
-                        print("-" * terminal_width)
+            for file_name in files_to_process:
+                if file_name not in available_files:
+                    print(f"Error: File {file_name} not found on server.")
+                    continue
+                print(f"I NEED {file_name}\n")
+                file_stat = client.stat(file_name)
+                if file_stat is None:
+                    continue
+                if file_stat[0] == 0:
+                    handle_empty_file(file_name)
+                    continue
+                position += 1
+                waiting.append(FileDownload(client, file_name, file_stat[0], file_stat[1], position, output_directory))
+
+            start_downloads(waiting, active, stop_signal, client.concurrency)
+
+            active[:] = [entry for entry in active if entry[0].is_alive()]
+            time.sleep(0.1)
 
     except KeyboardInterrupt:
         print("\n Download interrupted by user.")
         stop_signal.set()
+        # Let running downloads save their journals
+        for thread, _, _ in active:
+            thread.join()
     except Exception as e:
         print(f"Error: {e}")
     finally:
-        client_socket.close()
+        if os.path.exists(CONTROL_SOCKET):
+            os.remove(CONTROL_SOCKET)
         print("Client is shutting down...")
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Download files from the UDP file server. Without FILES, downloads the files "
+                    "added to input.txt or sent to the control socket until interrupted.")
+    parser.add_argument("files", nargs="*", metavar="FILES", help="files to download, then exit")
+    parser.add_argument("--host", help=f"server address (default {HOST}, asked for without FILES)")
+    parser.add_argument("--port", type=int, help=f"server port (default {PORT_NUM}, asked for without FILES)")
+    parser.add_argument("--concurrency", type=int, default=MAX_ACTIVE_FILES, help="large files downloaded at once")
+    parser.add_argument("--threads", type=int, default=MAX_DOWNLOAD_THREADS, help="receiving threads over all downloads")
+    parser.add_argument("--max-rate", type=int, default=MAX_DOWNLOAD_RATE, help="bytes/s over all downloads, 0 for unlimited")
+    parser.add_argument("--output", default=OUTPUT_DIRECTORY, help="download directory")
+    parser.add_argument("--progress", choices=["terminal", "json", "none"], default=PROGRESS_FORMAT)
+    parser.add_argument("--integrity", choices=list(INTEGRITY_MODES), default=PACKET_INTEGRITY,
+                        help="per-packet check; none relies on the manifest check at the end")
+    parser.add_argument("--json", action="store_true", help="print the per-file results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.files:
+        host = args.host or HOST
+        port = args.port or PORT_NUM
+    else:
+        host = args.host or input("Enter HOST IP: ")
+        port = args.port or int(input("Port: "))
+    client = Downloader(host, port, args.concurrency, args.threads, args.max_rate, args.progress, args.integrity)
+    if not args.files:
+        client_main(client, args.output)
+        return 0
+
+    try:
+        stats = client.download(args.files, args.output)
+    except KeyboardInterrupt:
+        print("\n Download interrupted by user.")
+        return 130
+    if args.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print()
+        for file_name, stat in stats.items():
+            if stat["status"] == "error":
+                print(f"{file_name}: error: {stat['error']}")
+            else:
+                print(f"{file_name}: {stat['status']}, {stat['bytes']} bytes in {stat['seconds']}s "
+                      f"({stat['rate'] / (1024 * 1024):.1f} MB/s)")
+    failed = [name for name, stat in stats.items() if stat["status"] not in ("downloaded", "up to date")]
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
-    client_main()
+    sys.exit(main())
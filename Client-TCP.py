@@ -3,12 +3,24 @@ import threading
 import os
 import time
 import sys
-
-
-# Cấu hình khách
-HOST = input("Enter HOST IP: ")
-PORT = int(input("Port: "))
-ADDR = (HOST, PORT)
+import struct
+import zlib
+import bz2
+import lzma
+import hashlib
+import json
+import argparse
+from collections import deque
+
+from client_common import (
+    JOURNAL_SUFFIX, PROGRESS_FORMAT, preallocate, write_at, merkle_root, missing_ranges,
+    RangeJournal, TokenBucket, ProgressReporter, follow_input_file, serve_control_socket,
+)
+
+
+# Cấu hình khách, mặc định khi không có tham số dòng lệnh
+HOST = "127.0.0.1"
+PORT = 8080
 FORMAT = 'utf-8'
 FILE_LIST_PATH = os.path.dirname(__file__)  
 OUTPUT_PATH = os.path.join(FILE_LIST_PATH, "output_folder")
@@ -16,130 +28,842 @@ OUTPUT_PATH = os.path.join(FILE_LIST_PATH, "output_folder")
 lock = threading.Lock()
 file_downloading_queue = []
 file_downloaded = []
-unit = 4096
-
-if not os.path.exists(OUTPUT_PATH):
-    os.makedirs(OUTPUT_PATH)
-
+unit = 64 * 1024
+
+# Binary framing (see Server-TCP.py): lets one connection pipeline many range requests
+USE_FRAMING = True
+FRAME_MAGIC = b"\x00F"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBHIQ")
+RANGE_REQUEST = struct.Struct("!QQ")
+SIZE_RESPONSE = struct.Struct("!Q")
+STAT_RESPONSE = struct.Struct("!Qd")  # size, mtime
+OP_HELLO = 0
+OP_LIST = 1
+OP_SIZE = 2
+OP_RANGE = 3
+OP_RANGES = 4
+OP_ZRANGE = 5
+OP_MANIFEST = 7
+OP_STAT = 8
+OP_ERROR = 255
+FLAG_MORE = 1
+RANGES_HEADER = struct.Struct("!H")
+RANGE_LENGTH = struct.Struct("!Q")
+MAX_REQUEST_PAYLOAD = 4096  # the server rejects larger request frames
+
+# Check downloads against the server's manifest (block hashes + Merkle root)
+# and download again only the blocks that don't match
+VERIFY_DOWNLOADS = True
+MAX_REPAIR_ROUNDS = 3
+MANIFEST_HEADER = struct.Struct("!QdII")  # size, mtime, block size, block count
+PIPELINE_CHUNK = 1024 * 1024  # size of each pipelined range request
+PIPELINE_DEPTH = 4  # range requests in flight per connection
+
+# Segment scheduler: the number of connections follows the file size and the
+# measured throughput, and idle connections take over the tail of slow segments
+MAX_SERVER_CONNECTIONS = 8  # connections open to the server at once
+MIN_SEGMENT = 4 * 1024 * 1024  # files are not split into segments smaller than this
+TARGET_SEGMENT_SECONDS = 2.0  # don't add connections that would finish sooner than this
+MIN_STEAL = 2 * PIPELINE_CHUNK  # smallest tail worth moving to another connection
+POOL_IDLE_TIMEOUT = 30.0  # idle pooled connections older than this are closed
+
+# Several files are downloaded at once, sharing the connection pool and a bandwidth budget
+MAX_ACTIVE_FILES = 3  # large files downloaded at the same time
+SMALL_FILE = PIPELINE_CHUNK  # files up to this size are fetched in batches over one connection
+SMALL_BATCH = 16  # small files per batch, a batch runs next to the large files
+DOWNLOAD_ORDER = "shortest"  # "shortest" file first, or "input" for the order of input.txt
+MAX_DOWNLOAD_RATE = 0  # bytes/s over all downloads, 0 for unlimited
+
+# Files can also be requested, one name per line, over the local unix socket
+# CONTROL_SOCKET (e.g. with `nc -U`)
+CONTROL_SOCKET = os.path.join(FILE_LIST_PATH, "client-tcp.sock")
+
+# With compression on (--compress), these codecs are offered to the server, which picks
+# one and compresses ranges block by block. Off by default: uncompressed ranges are
+# sent with sendfile, which is much faster than compressing on a fast network.
+COMPRESSION = False
+CODECS = ["zlib", "bz2", "lzma"]
+DECOMPRESSORS = {"zlib": zlib.decompress, "bz2": bz2.decompress, "lzma": lzma.decompress}
+HELLO_RESPONSE = struct.Struct("!I")
+BLOCK_HEADER = struct.Struct("!QIB")  # raw offset, raw length, method
+BLOCK_COMPRESSED = 1
+
+
+class Manifest:
+    """Block hashes of a file on the server."""
+    def __init__(self, data):
+        self.size, self.mtime, self.block_size, count = MANIFEST_HEADER.unpack_from(data)
+        start = MANIFEST_HEADER.size
+        self.root = data[start:start + 32]
+        self.hashes = [data[start + 32 * i:start + 32 * (i + 1)] for i in range(1, count + 1)]
+        if merkle_root(self.hashes) != self.root:
+            raise ValueError("Manifest does not match its Merkle root")
+
+    def block_range(self, index):
+        offset = index * self.block_size
+        return offset, min(self.block_size, self.size - offset)
+
+    def bad_blocks(self, path):
+        """Return the indexes of the blocks of `path` that don't match the manifest."""
+        bad = []
+        with open(path, "rb") as f:
+            for index, expected in enumerate(self.hashes):
+                if hashlib.sha256(f.read(self.block_size)).digest() != expected:
+                    bad.append(index)
+        return bad
+
+
+class FramedConnection:
+    """A connection to the server speaking the binary framing protocol."""
+    pipeline_depth = PIPELINE_DEPTH
+
+    def __init__(self, addr, codecs=()):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.next_id = 1
+        self.buffer = b""
+        hello_id = self.send_frame(OP_HELLO, ",".join(codecs).encode(FORMAT))
+        # The server greets every connection with the text file list, skip it
+        while FRAME_MAGIC not in self.buffer:
+            self.buffer = self.buffer[-1:] + self.recv_some()
+        self.buffer = self.buffer[self.buffer.index(FRAME_MAGIC):]
+        opcode, _, request_id, length = self.read_header()
+        if opcode != OP_HELLO or request_id != hello_id:
+            raise ConnectionError("Server does not support framing")
+
+        # Codec chosen by the server, None if ranges are sent uncompressed
+        self.codec = None
+        self.block_size = None
+        if length:
+            hello = self.recv_exact(length)
+            self.block_size, = HELLO_RESPONSE.unpack_from(hello)
+            self.codec = hello[HELLO_RESPONSE.size:].decode(FORMAT)
+
+    def recv_some(self):
+        data = self.sock.recv(unit)
+        if not data:
+            raise ConnectionError("Connection closed by server")
+        return data
+
+    def recv_exact(self, n):
+        while len(self.buffer) < n:
+            self.buffer += self.recv_some()
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def send_frame(self, opcode, payload=b""):
+        """Send a request frame and return its request id."""
+        request_id = self.next_id
+        self.next_id += 1
+        self.sock.sendall(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, opcode, 0, request_id, len(payload)) + payload)
+        return request_id
+
+    def read_header(self):
+        """Read a response header. Returns (opcode, flags, request id, payload length)."""
+        magic, version, opcode, flags, request_id, length = FRAME_HEADER.unpack(self.recv_exact(FRAME_HEADER.size))
+        if magic != FRAME_MAGIC or version != FRAME_VERSION:
+            raise ConnectionError("Invalid frame from server")
+        if opcode == OP_ERROR:
+            raise ConnectionError(self.recv_exact(length).decode(FORMAT))
+        return opcode, flags, request_id, length
+
+    def request(self, opcode, payload=b""):
+        """Send a request and wait for its whole response payload."""
+        self.send_frame(opcode, payload)
+        _, _, _, length = self.read_header()
+        return self.recv_exact(length)
+
+    def list_files(self):
+        return self.request(OP_LIST).decode(FORMAT)
+
+    def file_size(self, filename):
+        return SIZE_RESPONSE.unpack(self.request(OP_SIZE, filename.encode(FORMAT)))[0]
+
+    def file_stat(self, filename):
+        """Return (size, mtime) of a file on the server."""
+        return STAT_RESPONSE.unpack(self.request(OP_STAT, filename.encode(FORMAT)))
+
+    def manifest(self, filename):
+        return Manifest(self.request(OP_MANIFEST, filename.encode(FORMAT)))
+
+    def request_range(self, filename, offset, length):
+        """Pipeline a range request, compressed if a codec was negotiated. Returns its request id."""
+        opcode = OP_ZRANGE if self.codec else OP_RANGE
+        return self.send_frame(opcode, RANGE_REQUEST.pack(offset, length) + filename.encode(FORMAT))
+
+    def receive_range(self, request_id, fd, offset, length, progress):
+        """Write the response to a request_range() at its offset in the file open as `fd`.
+
+        progress(n) is called with the number of bytes of the range received so far.
+        """
+        if not self.codec:
+            _, _, response_id, response_len = self.read_header()
+            if response_id != request_id or response_len != length:
+                raise ConnectionError(f"Unexpected response {response_id} ({response_len} bytes)")
+            for done in self.recv_into_file(fd, offset, length):
+                progress(done)
+            return
 
-def download_chunk(filename, offset, length, part_num, stop_event, progress_dict, lock):
+        done = 0
+        flags = FLAG_MORE
+        while flags & FLAG_MORE:
+            _, flags, response_id, response_len = self.read_header()
+            if response_id != request_id:
+                raise ConnectionError(f"Unexpected response {response_id}")
+            if response_len == 0:
+                break
+            block_offset, raw_len, method = BLOCK_HEADER.unpack(self.recv_exact(BLOCK_HEADER.size))
+            data = self.recv_exact(response_len - BLOCK_HEADER.size)
+            if method == BLOCK_COMPRESSED:
+                data = DECOMPRESSORS[self.codec](data)
+            if len(data) != raw_len:
+                raise ConnectionError(f"Corrupted block at offset {block_offset}")
+            write_at(fd, data, block_offset)
+            done += raw_len
+            progress(done)
+        if done != length:
+            raise ConnectionError(f"Range {offset}+{length} incomplete: {done} bytes")
+
+    def fetch_ranges(self, filename, ranges):
+        """Fetch a list of (offset, length) ranges of a file.
+
+        Ranges are sent in as few RANGES requests as fit in a frame, all pipelined.
+        Returns the data of each range (shorter for ranges past the end of the file).
+        """
+        name = filename.encode(FORMAT)
+        per_request = (MAX_REQUEST_PAYLOAD - RANGES_HEADER.size - len(name)) // RANGE_REQUEST.size
+        batches = [ranges[i:i + per_request] for i in range(0, len(ranges), per_request)]
+        for batch in batches:
+            payload = RANGES_HEADER.pack(len(name)) + name
+            payload += b"".join(RANGE_REQUEST.pack(offset, length) for offset, length in batch)
+            self.send_frame(OP_RANGES, payload)
+
+        results = []
+        for batch in batches:
+            self.read_header()
+            lengths = [RANGE_LENGTH.unpack(self.recv_exact(RANGE_LENGTH.size))[0] for _ in batch]
+            results.extend(self.recv_exact(length) for length in lengths)
+        return results
+
+    def recv_into_file(self, fd, offset, length):
+        """Copy `length` payload bytes of the current response to `offset` in the file open as `fd`."""
+        data = self.recv_exact(min(length, len(self.buffer)))
+        write_at(fd, data, offset)
+        received = len(data)
+        while received < length:
+            chunk = self.sock.recv(min(unit, length - received))
+            if not chunk:
+                raise ConnectionError("Connection closed by server")
+            write_at(fd, chunk, offset + received)
+            received += len(chunk)
+            yield received
+
+    def healthy(self):
+        return not self.buffer and socket_alive(self.sock)
+
+    def close(self):
+        self.sock.close()
+
+
+def socket_alive(sock):
+    """True if the peer has not closed the socket and no stray data is waiting on it."""
+    timeout = sock.gettimeout()
+    sock.setblocking(False)  # socket.MSG_DONTWAIT doesn't exist on Windows
     try:
-        if stop_event.is_set():
-            return  
-
-        temp_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        temp_conn.connect(ADDR)
-        temp_conn.recv(1024).decode(FORMAT)
+        sock.recv(1, socket.MSG_PEEK)
+        return False  # either closed (b"") or out of sync
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+class ConnectionPool:
+    """Keeps connections to each server open between ranges and files.
+
+    At most `limit` connections per server are open at once, plus one for
+    each `reserved` use so it never waits behind large downloads: "batch"
+    for small-file batches and "control" for list and stat calls.
+    acquire() blocks until one is free. The banner is only received when a
+    connection is first opened.
+    """
+    def __init__(self, limit=MAX_SERVER_CONNECTIONS, idle_timeout=POOL_IDLE_TIMEOUT, framing=USE_FRAMING, codecs=()):
+        self.limit = limit
+        self.idle_timeout = idle_timeout
+        self.framing = framing
+        self.codecs = codecs  # offered by framed connections
+        self.lock = threading.Lock()
+        self.slots = {}  # (address, reserved use or None) -> semaphore of connections in use
+        self.idle = {}  # address -> [(connection, released at)]
+
+    def acquire(self, addr, reserved=None):
+        with self.lock:
+            slots = self.slots.setdefault((addr, reserved), threading.BoundedSemaphore(1 if reserved else self.limit))
+        slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    self.evict_idle(addr)
+                    idle = self.idle.get(addr)
+                    conn = idle.pop()[0] if idle else None
+                if conn is None:
+                    return FramedConnection(addr, self.codecs) if self.framing else LegacyConnection(addr)
+                if conn.healthy():
+                    return conn
+                conn.close()
+        except Exception:
+            slots.release()
+            raise
+
+    def release(self, addr, conn, reuse=True, reserved=None):
+        """Give a connection back, or close it if it has unread responses or failed."""
+        if reuse and conn.healthy():
+            with self.lock:
+                self.idle.setdefault(addr, []).append((conn, time.monotonic()))
+        else:
+            conn.close()
+        self.slots[(addr, reserved)].release()
+
+    def evict_idle(self, addr):
+        now = time.monotonic()
+        idle = self.idle.get(addr, [])
+        for conn, released in idle:
+            if now - released > self.idle_timeout:
+                conn.close()
+        idle[:] = [(conn, released) for conn, released in idle if now - released <= self.idle_timeout]
+
+    def close_all(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self.idle.clear()
+
+
+class LegacyConnection:
+    """A connection using the text protocol, one range request at a time."""
+    pipeline_depth = 1
+
+    def __init__(self, addr):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.banner = self.sock.recv(1024).decode(FORMAT)
+        self.block_size = None
+
+    def list_files(self):
+        return self.banner
+
+    def file_stat(self, filename):
+        self.sock.send(f"STAT {filename}".encode(FORMAT))
+        response = self.sock.recv(1024).decode(FORMAT)
+        if "Error" in response:
+            raise ConnectionError(response)
+        size, mtime = response.split()
+        return int(size), float(mtime)
+
+    def request_range(self, filename, offset, length):
+        self.sock.send(f"{filename} {offset} {length}".encode(FORMAT))
+        return None
+
+    def receive_range(self, request_id, fd, offset, length, progress):
+        received = 0
+        while received < length:
+            chunk = self.sock.recv(min(unit, length - received))
+            if not chunk:
+                raise ConnectionError("Connection closed by server")
+            write_at(fd, chunk, offset + received)
+            received += len(chunk)
+            progress(received)
+
+    def healthy(self):
+        return socket_alive(self.sock)
+
+    def close(self):
+        self.sock.close()
+
+
+class Segment:
+    """A byte range of a file downloaded by one connection."""
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end  # lowered when another connection takes over the tail
+        self.requested = start  # range requests were sent up to here
+        self.received = 0
+        self.started = None
+
+    def remaining(self):
+        return self.end - self.start - self.received
+
+    def time_left(self, now):
+        """Estimated seconds to finish at the segment's current rate."""
+        if not self.received:
+            return float("inf")
+        return self.remaining() * (now - self.started) / self.received
+
+
+class SegmentScheduler:
+    """Splits a file into segments and balances them over the download connections.
+
+    A connection that finishes its segment takes over the second half of the
+    not yet requested part of the segment expected to finish last.
+    """
+    connection_rate = None  # bytes/s of one connection, averaged over past downloads
+
+    def __init__(self, file_size, align=PIPELINE_CHUNK, missing=None, max_connections=MAX_SERVER_CONNECTIONS):
+        self.lock = threading.Lock()
+        self.align = align
+        self.segments = []
+        self.pending = deque()
+        self.started = time.monotonic()
+        missing = [(0, file_size)] if missing is None else missing
+        self.total = sum(end - start for start, end in missing)  # bytes to download
+        self.connections = self.plan_connections(self.total, max_connections)
+        step = -(-self.total // self.connections)
+        step = -(-step // align) * align
+        for first, last in missing:
+            for start in range(first, last, step):
+                self.add_segment(start, min(start + step, last))
+        self.connections = min(self.connections, len(self.segments))
+
+    @classmethod
+    def plan_connections(cls, file_size, max_connections=MAX_SERVER_CONNECTIONS):
+        connections = max(1, file_size // MIN_SEGMENT)
+        if cls.connection_rate:
+            # More connections only pay off if each one runs long enough to ramp up
+            seconds = file_size / cls.connection_rate
+            connections = min(connections, max(1, int(seconds / TARGET_SEGMENT_SECONDS)))
+        return min(max_connections, connections)
+
+    def add_segment(self, start, end):
+        segment = Segment(start, end)
+        self.segments.append(segment)
+        self.pending.append(segment)
+        return segment
+
+    def next_segment(self):
+        """Return a segment for an idle connection, None when nothing is left to split."""
+        with self.lock:
+            if not self.pending:
+                self.steal()
+            if not self.pending:
+                return None
+            segment = self.pending.popleft()
+            segment.started = time.monotonic()
+            return segment
+
+    def steal(self):
+        now = time.monotonic()
+        active = [s for s in self.segments if s.started is not None and s.end - s.requested >= MIN_STEAL]
+        if not active:
+            return
+        victim = max(active, key=lambda s: s.time_left(now))
+        split = victim.requested + (victim.end - victim.requested) // 2
+        split = -(-split // self.align) * self.align
+        if victim.end - split < self.align:
+            return
+        self.add_segment(split, victim.end)
+        victim.end = split
+
+    def reserve(self, segment, limit):
+        """Claim the next range of a segment to request. Returns (offset, length), length 0 when done."""
+        with self.lock:
+            length = min(limit, segment.end - segment.requested)
+            offset = segment.requested
+            segment.requested += length
+            return offset, length
+
+    def failed(self, segment):
+        """Give the part of a segment that was not received to another connection."""
+        with self.lock:
+            end, segment.end = segment.end, segment.start + segment.received
+            segment.requested = segment.end
+            if segment.end < end:
+                self.add_segment(segment.end, end)
+
+    def received(self):
+        return sum(s.received for s in self.segments)
+
+    def complete(self):
+        return self.received() == self.total
+
+    def finish(self):
+        """Remember the per-connection throughput for sizing the next download."""
+        elapsed = time.monotonic() - self.started
+        if not self.complete() or elapsed <= 0 or not self.connections:
+            return
+        rate = self.total / elapsed / self.connections
+        previous = SegmentScheduler.connection_rate
+        SegmentScheduler.connection_rate = rate if previous is None else 0.7 * previous + 0.3 * rate
 
-        request = f"{filename} {offset} {length}"
-        temp_conn.send(request.encode(FORMAT))
 
-        received = 0
-        with open(f"{filename}.part{part_num}", "wb") as f:
-            while received < length:
-                if stop_event.is_set():
-                    break
-                chunk = temp_conn.recv(min(unit, length - received))
-                if not chunk:
+def download_segment(conn, download, fd, journal, segment, scheduler, stop_event):
+    """Download a segment straight into the output file, pipelining requests while the segment lasts."""
+    pending = deque()  # (request id, offset, length) in request order
+    try:
+        while not stop_event.is_set():
+            while len(pending) < conn.pipeline_depth:
+                offset, size = scheduler.reserve(segment, PIPELINE_CHUNK)
+                if not size:
                     break
-                f.write(chunk)
-                received += len(chunk)
-
-                # Tính phần trăm tiến trình và cập nhật vào dict
-                percent_complete = int((received / length) * 100)
-                with lock:
-                    progress_dict[part_num] = percent_complete
-
-                # Hiển thị tiến trình của tất cả các part
-                with lock:
-                    sys.stdout.write("\rDownloading ")
-                    sys.stdout.write(" | ".join(
-                        [f"Part {i}: {progress_dict.get(i, 0)}%" for i in range(1, 5)]
-                    ))
-                    sys.stdout.flush()
-        if received != length:
-            print(f"\nPart {part_num} incomplete! {received}/{length} downloaded")
-        else:
-            with lock:
-                progress_dict[part_num] = 100  # Đảm bảo hoàn tất hiển thị
-
-    except Exception as e:
-        print(f"\nError downloading part {part_num} of {filename}: {e}")
+                download.client.bandwidth.consume(size)
+                pending.append((conn.request_range(download.filename, offset, size), offset, size))
+            if not pending:
+                break
+            request_id, offset, size = pending.popleft()
+            received = segment.received
+
+            def progress(done):
+                segment.received = received + done
+
+            conn.receive_range(request_id, fd, offset, size, progress)
+            segment.received = received + size
+            journal.record(offset, size)
     finally:
-        temp_conn.close()
-
+        if segment.remaining():
+            scheduler.failed(segment)
 
 
-def merge_file(filename, num_parts):
+def segment_worker(download, fd, journal, scheduler, stop_event):
+    """Take segments from the scheduler and download them over one pooled connection."""
+    client = download.client
+    conn = None
+    reuse = False
     try:
-        file_path = os.path.join(OUTPUT_PATH, filename)
-        total_size = 0
-        completed_size = 0
-
-        # Tính tổng kích thước tất cả các phần
-        for i in range(1, num_parts + 1):
-            part_filename = f"{filename}.part{i}"
-            if not os.path.exists(part_filename):
-                print(f"\n{part_filename} is missing. Skip merging.")
-                return
-            total_size += os.path.getsize(part_filename)
-
-        with open(file_path, "wb") as outfile:
-            for i in range(1, num_parts + 1):
-                part_filename = f"{filename}.part{i}"
-                if not os.path.exists(part_filename):
-                    print(f"\n{part_filename}. Skip merging.")
-                    return
-                with open(part_filename, "rb") as infile:
-                    while chunk := infile.read(1024 * 1024):  # Đọc từng chunk 1MB
-                        outfile.write(chunk)
-                        completed_size += len(chunk)
-
-                        # Hiển thị tiến trình hợp nhất
-                        percent_complete = int((completed_size / total_size) * 100)
-                        sys.stdout.write(f"\rMerging {filename}: {percent_complete}% complete")
-                        sys.stdout.flush()
-
-                os.remove(part_filename)
-
-        print(f"\n-->File {filename} merged successfully.")
-
+        conn = client.pool.acquire(client.addr)
+        segment = scheduler.next_segment()
+        while segment is not None and not stop_event.is_set():
+            download_segment(conn, download, fd, journal, segment, scheduler, stop_event)
+            segment = scheduler.next_segment()
+        # Responses may still be in flight after a stop
+        reuse = not stop_event.is_set()
     except Exception as e:
-        print(f"\nError merging file {filename}: {e}")
-
+        print(f"\nError downloading {download.filename}: {e}")
+    finally:
+        if conn:
+            client.pool.release(client.addr, conn, reuse)
+
+
+def verify_download(conn, filename, file_path):
+    """Check a downloaded file against its manifest and download bad blocks again.
+
+    Returns True if the file matches the manifest.
+    """
+    manifest = conn.manifest(filename)
+    if os.path.getsize(file_path) != manifest.size:
+        print(f"\n{filename}: size {os.path.getsize(file_path)} does not match the server ({manifest.size})")
+        return False
+    for _ in range(MAX_REPAIR_ROUNDS):
+        bad = manifest.bad_blocks(file_path)
+        if not bad:
+            print(f"{filename} verified ({len(manifest.hashes)} blocks)")
+            return True
+        print(f"{filename}: {len(bad)} corrupted block(s), downloading them again")
+        ranges = [manifest.block_range(index) for index in bad]
+        with open(file_path, "r+b") as f:
+            for (offset, _), data in zip(ranges, conn.fetch_ranges(filename, ranges)):
+                f.seek(offset)
+                f.write(data)
+    print(f"{filename} is still corrupted after {MAX_REPAIR_ROUNDS} attempts")
+    return False
+
+
+class FileDownload:
+    """A file queued for download from `client`'s server into `output_path`, with its size and mtime on the server."""
+    def __init__(self, client, filename, size, mtime, position, output_path):
+        self.client = client
+        self.filename = filename
+        self.path = os.path.join(output_path, filename)
+        self.size = size
+        self.mtime = mtime
+        self.position = position  # order in which it was requested
+        self.skipped = 0  # bytes already on disk when the download started
+        self.scheduler = None  # SegmentScheduler of a large file
+        self.received = 0  # bytes received, for small files
+        self.started = None
+        self.finished = None
+        self.status = "waiting"
+
+    def done(self):
+        """Bytes on disk. Only reads counters that each worker updates on its own."""
+        return self.skipped + (self.scheduler.received() if self.scheduler else self.received)
+
+    def stats(self):
+        """Outcome of the download: status, bytes transferred, time taken and average rate."""
+        seconds = (self.finished or time.monotonic()) - self.started if self.started else 0.0
+        transferred = self.done() - self.skipped
+        return {"status": self.status, "size": self.size, "bytes": transferred, "resumed_from": self.skipped,
+                "seconds": round(seconds, 3), "rate": round(transferred / seconds) if seconds > 0 else 0}
+
+
+def open_download(download):
+    """Open the output file of a download, resuming from its journal if there is one.
+
+    Returns (fd, journal, missing ranges), or None if the file is already up to date.
+    """
+    filename, file_size, mtime = download.filename, download.size, download.mtime
+    file_path = download.path
+    journal_path = file_path + JOURNAL_SUFFIX
+    download.started = time.monotonic()
+    download.status = "downloading"
+    done = RangeJournal.load(journal_path, file_size, mtime)
+    if done is not None and os.path.isfile(file_path) and os.path.getsize(file_path) == file_size:
+        fd = os.open(file_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        missing = missing_ranges(done, file_size)
+        download.skipped = file_size - sum(end - start for start, end in missing)
+        print(f"\nResuming {filename}: {download.skipped}/{file_size} bytes on disk")
+    elif (done is None and not os.path.exists(journal_path) and os.path.isfile(file_path)
+          and (os.path.getsize(file_path), os.path.getmtime(file_path)) == (file_size, mtime)):
+        print(f"\n{filename} is already up to date.")
+        download.status = "up to date"
+        download.finished = time.monotonic()
+        return None
+    else:
+        fd = preallocate(file_path, file_size)
+        done = None
+        missing = [(0, file_size)]
+    return fd, RangeJournal(journal_path, fd, file_size, mtime, done), missing
+
+
+def finish_download(download, fd, journal, complete):
+    """Close a download. A complete one is verified and gets the server's mtime."""
+    if complete:
+        journal.remove()
+    else:
+        journal.close()
+    os.close(fd)
+    download.finished = time.monotonic()
+    if not complete:
+        print(f"\n{download.filename} incomplete! {download.done()}/{download.size} bytes on disk, will resume next time")
+        download.status = "incomplete"
+        return
+    download.status = "downloaded"
+    client = download.client
+    if client.framing and VERIFY_DOWNLOADS:
+        conn = client.pool.acquire(client.addr)
+        reuse = False
+        try:
+            if not verify_download(conn, download.filename, download.path):
+                download.status = "corrupted"
+            reuse = True
+        finally:
+            client.pool.release(client.addr, conn, reuse)
+    if download.status == "corrupted":
+        # Left with its local mtime, so the next run downloads it again
+        return
+    # The server's mtime marks the file as up to date once the journal is gone
+    os.utime(download.path, (time.time(), download.mtime))
+    print(f"\nI received {download.filename}. Thanks.")
+
+
+def download_file(download, align, stop_event):
+    """Download a large file over several pooled connections."""
+    opened = open_download(download)
+    if opened is None:
+        return
+    fd, journal, missing = opened
+    # No more workers than the pool lets connect, the others would only wait for a connection
+    scheduler = SegmentScheduler(download.size, align, missing, download.client.pool.limit)
+    download.scheduler = scheduler
+    threads = []
+    for _ in range(scheduler.connections):
+        thread = threading.Thread(
+            target=segment_worker,
+            args=(download, fd, journal, scheduler, stop_event)
+        )
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    scheduler.finish()
+    finish_download(download, fd, journal, scheduler.complete())
+
+
+def download_small_files(downloads, stop_event):
+    """Download a batch of small files over one pooled connection, pipelining their requests."""
+    opened = []
+    requests = deque()  # (download, fd, journal, offset, length)
+    for download in downloads:
+        result = open_download(download)
+        if result is not None:
+            fd, journal, missing = result
+            opened.append((download, fd, journal, missing))
+            requests.extend((download, fd, journal, start, end - start) for start, end in missing)
+
+    client = downloads[0].client
+    conn = None
+    reuse = False
+    try:
+        if requests:
+            conn = client.pool.acquire(client.addr, reserved="batch")
+        pending = deque()
+        while (requests or pending) and not stop_event.is_set():
+            while requests and len(pending) < conn.pipeline_depth:
+                download, fd, journal, offset, size = requests.popleft()
+                client.bandwidth.consume(size)
+                pending.append((conn.request_range(download.filename, offset, size), download, fd, journal, offset, size))
+            request_id, download, fd, journal, offset, size = pending.popleft()
+            conn.receive_range(request_id, fd, offset, size, lambda done: None)
+            journal.record(offset, size)
+            download.received += size
+        reuse = not pending
+    except Exception as e:
+        print(f"\nError downloading {', '.join(d.filename for d in downloads)}: {e}")
+    finally:
+        if conn:
+            client.pool.release(client.addr, conn, reuse, reserved="batch")
+
+    for download, fd, journal, missing in opened:
+        finish_download(download, fd, journal, download.done() == download.size)
+
+
+def start_downloads(waiting, active, align, stop_event, max_active=MAX_ACTIVE_FILES):
+    """Start queued downloads while the budget allows: up to `max_active` large
+    files, plus one batch of small files so they don't wait behind large ones."""
+    if DOWNLOAD_ORDER == "shortest":
+        waiting.sort(key=lambda d: (d.size, d.position))
+    else:
+        waiting.sort(key=lambda d: d.position)
+
+    if not any(small for _, _, small in active):
+        batch = [d for d in waiting if d.size <= SMALL_FILE][:SMALL_BATCH]
+        if batch:
+            for download in batch:
+                waiting.remove(download)
+            thread = threading.Thread(target=download_small_files, args=(batch, stop_event))
+            active.append((thread, batch, True))
+            thread.start()
+
+    large = [d for d in waiting if d.size > SMALL_FILE]
+    running = sum(1 for _, _, small in active if not small)
+    for download in large[:max(0, max_active - running)]:
+        waiting.remove(download)
+        thread = threading.Thread(target=download_file, args=(download, align, stop_event))
+        active.append((thread, [download], False))
+        thread.start()
+
+
+class Downloader:
+    """Downloads files from one server; the interface for other programs.
+
+    Holds the connection settings, a connection pool and a bandwidth budget.
+    Nothing is asked or created until download() is called.
+    """
+    def __init__(self, host=HOST, port=PORT, concurrency=MAX_ACTIVE_FILES, connections=MAX_SERVER_CONNECTIONS,
+                 max_rate=MAX_DOWNLOAD_RATE, framing=USE_FRAMING, progress="none", compress=COMPRESSION):
+        self.addr = (host, port)
+        self.concurrency = concurrency  # large files downloaded at the same time
+        self.framing = framing
+        self.progress = progress  # PROGRESS_FORMAT shown while download() runs
+        self.pool = ConnectionPool(connections, framing=framing, codecs=CODECS if compress else ())
+        self.bandwidth = TokenBucket(max_rate)
+        self.align = None
+
+    def call(self, method, *args):
+        """Call a method of a pooled connection, on the control connection so transfers don't hold it up."""
+        conn = self.pool.acquire(self.addr, reserved="control")
+        reuse = False
+        try:
+            if self.align is None:
+                self.align = PIPELINE_CHUNK
+                if conn.block_size and PIPELINE_CHUNK % conn.block_size:
+                    # Align segments on compression blocks so the server can reuse cached blocks
+                    self.align = conn.block_size
+            result = getattr(conn, method)(*args)
+            reuse = True
+            return result
+        finally:
+            self.pool.release(self.addr, conn, reuse, reserved="control")
+
+    def list_files(self):
+        """The server's file list, one "name size" line per file."""
+        return self.call("list_files")
+
+    def stat(self, filename):
+        """(size, mtime) of a file on the server. Raises ConnectionError if it does not exist."""
+        return self.call("file_stat", filename)
+
+    def download(self, names, dest=OUTPUT_PATH, stop_event=None):
+        """Download the files in `names` into `dest` and wait for them.
+
+        Returns {filename: stats} with the status ("downloaded", "up to date",
+        "incomplete", "corrupted" or "error"), bytes transferred, seconds and rate
+        of each file. Setting `stop_event` stops the downloads, which resume on
+        the next call.
+        """
+        os.makedirs(dest, exist_ok=True)
+        stop_event = stop_event or threading.Event()
+        stats = {}
+        downloads = []
+        for position, filename in enumerate(dict.fromkeys(names), 1):
+            try:
+                size, mtime = self.stat(filename)
+            except (ConnectionError, OSError, ValueError) as e:
+                stats[filename] = {"status": "error", "error": str(e)}
+                continue
+            download = FileDownload(self, filename, size, mtime, position, dest)
+            if size == 0:
+                open(download.path, "wb").close()
+                os.utime(download.path, (time.time(), mtime))
+                download.started = download.finished = time.monotonic()
+                download.status = "downloaded"
+            downloads.append(download)
+
+        waiting = [download for download in downloads if download.status == "waiting"]
+        active = []  # (thread, FileDownloads, small batch) of running downloads
+        reporter_stop = threading.Event()
+        reporter = ProgressReporter(lambda: [download for _, batch, _ in active for download in batch], self.progress)
+        threading.Thread(target=reporter.run, args=(reporter_stop,), daemon=True).start()
+        try:
+            while (waiting and not stop_event.is_set()) or active:
+                if not stop_event.is_set():
+                    start_downloads(waiting, active, self.align, stop_event, self.concurrency)
+                active[:] = [entry for entry in active if entry[0].is_alive()]
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            stop_event.set()
+            # Let running downloads save their journals
+            for thread, _, _ in active:
+                thread.join()
+            raise
+        finally:
+            reporter_stop.set()
+
+        for download in downloads:
+            stats[download.filename] = download.stats()
+        return stats
+
+    def close(self):
+        self.pool.close_all()
+
+
+def queue_files(names):
+    """Add requested files to the download queue, skipping known ones. Returns the names added."""
+    with lock:
+        added = [name for name in dict.fromkeys(names)
+                 if name not in file_downloading_queue and name not in file_downloaded]
+        file_downloading_queue.extend(added)
+    return added
 
-def remove_parts(filename, num_parts):
-    # Xóa các phần của file
-    for i in range(1, num_parts + 1):
-        part_filename = f"{filename}.part{i}"
-        if os.path.exists(part_filename):
-            os.remove(part_filename)
-            print(f"Removed {part_filename}")
 
 def monitor_input_file():
-    input_path = os.path.join(FILE_LIST_PATH, "input.txt")
-    while True:
-        if os.path.exists(input_path):
-            with open(input_path, 'r') as file:
-                files_to_download = set(line.strip() for line in file if line.strip())
-            with lock:
-                # thêm file mới vào hàng đợi
-                for file in files_to_download:
-                    if file not in file_downloading_queue and file not in file_downloaded:
-                        file_downloading_queue.append(file)
-        time.sleep(5)
+    """Queue the files listed in input.txt as soon as they are added to it."""
+    # thêm file mới vào hàng đợi
+    follow_input_file(os.path.join(FILE_LIST_PATH, "input.txt"), queue_files)
+
 
-def client_program():
+def client_program(client, output_path=OUTPUT_PATH):
+    """Download the files added to input.txt or sent to the control socket until interrupted."""
     stop_event = threading.Event()
-    progress_dict = {}  # theo dõi tiến độ
-    lock = threading.Lock()  # Khóa đảm bảo tính ổn định trong môi trường đa luồng
+    active = []  # (thread, FileDownloads, small batch) of running downloads
     try:
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect(ADDR)
-        print(f"***Client connected to {HOST}:{PORT}***")
-
+        os.makedirs(output_path, exist_ok=True)
         # Nhận và hiển thị danh sách file Server có
-        file_list = client.recv(1024).decode(FORMAT)
+        file_list = client.list_files()
+        host, port = client.addr
+        print(f"***Client connected to {host}:{port}***")
         if not file_list:
             print("No responses")
             return
@@ -154,89 +878,112 @@ def client_program():
 
         monitor_thread = threading.Thread(target=monitor_input_file, daemon=True)
         monitor_thread.start()
-        printed_files = []
+        threading.Thread(target=serve_control_socket, args=(CONTROL_SOCKET, queue_files), daemon=True).start()
+        reporter = ProgressReporter(lambda: [download for _, batch, _ in active for download in batch], client.progress)
+        threading.Thread(target=reporter.run, args=(stop_event,), daemon=True).start()
+        waiting = []  # FileDownloads not started yet
+        position = 0
 
         while True:
             with lock:
                 files_to_download = file_downloading_queue.copy()
+                file_downloading_queue.clear()
+                file_downloaded.extend(files_to_download)
 
-            if files_to_download and set(files_to_download) != printed_files:
-                printed_files = files_to_download.copy()
-
+            if files_to_download:
                 print("\nFile waiting for download:")
                 for filename in files_to_download:
                     print(f"  {filename}")
-                if not files_to_download:
-                    print(" None")
                 print("*"*100)
 
-                for filename in files_to_download:
-                    file_downloading_queue.remove(filename)
-                    file_downloaded.append(filename)
-                    if filename in available_files:
-                        print(f"I need {filename}, give me, please.\n")
-                        client.send(filename.encode(FORMAT))
-                        response = client.recv(1024).decode(FORMAT)
-
-                        if "Error" in response:
-                            print(response)
-                            continue
-
-                        file_size = int(response)
-
-                        if file_size == 0:
-                            print(f"File {filename} is empty.")
-                            print(f"{filename} downloaded successfully (empty file).")
-                            continue
-
-                        num_parts = min(4, file_size)  # giới hạn 4 phần
-                        part_size = file_size // num_parts
-                        threads = []
-
-                        for i in range(1, num_parts + 1):
-                            offset = (i - 1) * part_size
-                            length = part_size if i < num_parts else file_size - offset
-                            thread = threading.Thread(
-                                target=download_chunk,
-                                args=(filename, offset, length, i, stop_event, progress_dict, lock)
-                            )
-                            threads.append(thread)
-                            thread.start()
-
-                        while any(thread.is_alive() for thread in threads):
-                            with lock:
-                                sys.stdout.write("\r")
-                                sys.stdout.write(" | ".join(
-                                    [f"Part {i}: {progress_dict.get(i, 0)}%" for i in range(1, num_parts + 1)]
-                                ))
-                                sys.stdout.flush()
-                            time.sleep(0.1)
-
-                        for thread in threads:
-                            thread.join()
-
-                        if not stop_event.is_set():
-                            sys.stdout.write("\n")
-                            merge_file(filename, num_parts)
-                            print(f"\nI received {filename}. Thanks.")
-                            print("-"*100)
-                        else:
-                            remove_parts(filename, num_parts)
-                            print("Cleanup completed.")
-                            break
-
-                    else:
-                        print(f"Error: File {filename} not found.")
+            for filename in files_to_download:
+                if filename not in available_files:
+                    print(f"Error: File {filename} not found.")
+                    continue
+                try:
+                    file_size, mtime = client.stat(filename)
+                except ConnectionError as e:
+                    print(e)
+                    continue
+
+                if file_size == 0:
+                    print(f"File {filename} is empty.")
+                    print(f"{filename} downloaded successfully (empty file).")
+                    continue
+
+                position += 1
+                waiting.append(FileDownload(client, filename, file_size, mtime, position, output_path))
+
+            start_downloads(waiting, active, client.align, stop_event, client.concurrency)
+
+            active[:] = [entry for entry in active if entry[0].is_alive()]
+            time.sleep(0.1)
 
     except KeyboardInterrupt:
         print("\nProcess is interrupted")
         stop_event.set()  # tín hiệu kết thúc đa luồng
+        # Let running downloads save their journals
+        for thread, _, _ in active:
+            thread.join()
 
     except Exception as e:
         print(f"Error: {e}")
     finally:
         client.close()
+        if os.path.exists(CONTROL_SOCKET):
+            os.remove(CONTROL_SOCKET)
         print("Client is shutting down...")
 
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Download files from the TCP file server. Without FILES, downloads the files "
+                    "added to input.txt or sent to the control socket until interrupted.")
+    parser.add_argument("files", nargs="*", metavar="FILES", help="files to download, then exit")
+    parser.add_argument("--host", help=f"server address (default {HOST}, asked for without FILES)")
+    parser.add_argument("--port", type=int, help=f"server port (default {PORT}, asked for without FILES)")
+    parser.add_argument("--concurrency", type=int, default=MAX_ACTIVE_FILES, help="large files downloaded at once")
+    parser.add_argument("--connections", type=int, default=MAX_SERVER_CONNECTIONS, help="connections to the server")
+    parser.add_argument("--max-rate", type=int, default=MAX_DOWNLOAD_RATE, help="bytes/s over all downloads, 0 for unlimited")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="download directory")
+    parser.add_argument("--progress", choices=["terminal", "json", "none"], default=PROGRESS_FORMAT)
+    parser.add_argument("--legacy", action="store_true", help="use the text protocol instead of framing")
+    parser.add_argument("--compress", action="store_true", help="ask the server to compress ranges, for slow links")
+    parser.add_argument("--json", action="store_true", help="print the per-file results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.files:
+        host = args.host or HOST
+        port = args.port or PORT
+    else:
+        host = args.host or input("Enter HOST IP: ")
+        port = args.port or int(input("Port: "))
+    client = Downloader(host, port, args.concurrency, args.connections, args.max_rate,
+                        not args.legacy, args.progress, args.compress)
+    if not args.files:
+        client_program(client, args.output)
+        return 0
+
+    try:
+        stats = client.download(args.files, args.output)
+    except KeyboardInterrupt:
+        print("\nProcess is interrupted")
+        return 130
+    finally:
+        client.close()
+    if args.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print()
+        for filename, stat in stats.items():
+            if stat["status"] == "error":
+                print(f"{filename}: error: {stat['error']}")
+            else:
+                print(f"{filename}: {stat['status']}, {stat['bytes']} bytes in {stat['seconds']}s "
+                      f"({stat['rate'] / (1024 * 1024):.1f} MB/s)")
+    failed = [name for name, stat in stats.items() if stat["status"] not in ("downloaded", "up to date")]
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
-    client_program()
\ No newline at end of file
+    sys.exit(main())
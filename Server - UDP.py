@@ -4,6 +4,15 @@ import os
 import struct
 import hashlib
 import time
+import json
+import mmap
+import queue
+import sys
+import argparse
+import zlib
+import heapq
+import itertools
+from collections import Counter, OrderedDict, deque
 
 
 PORT = 8080
@@ -15,66 +24,639 @@ FORMAT = 'utf-8'
 FILE_LIST_PATH = os.path.dirname(__file__)
 SOURCE_FILE_PATH = os.path.join(FILE_LIST_PATH, "server_files")
 
-CHUNK_SIZE = 1024
-ack = set()
+CHUNK_SIZE = 1024  # payload of a data packet unless the client asks for another size
+MANIFEST_BLOCK = 1024 * CHUNK_SIZE  # bytes hashed per manifest entry
+MANIFEST_PAGE = 1000  # most block hashes per MANIFEST reply datagram
+MAX_MANIFESTS = 256  # manifests kept in memory
+# size, mtime, block size, block count, first block of the page (then root and hashes)
+MANIFEST_HEADER = struct.Struct("!QdIII")
+# Data packets: seq, integrity mode, then the mode's digest of the payload and the payload.
+# The client asks for a mode in its RANGE request; modes not in ALLOWED_INTEGRITY fall back to sha256.
+PACKET_HEADER = struct.Struct("!QB")
+INTEGRITY_MODES = {"none": 0, "crc32": 1, "sha256": 2}
+ALLOWED_INTEGRITY = ("none", "crc32", "sha256")
+# The client probes the path with PROBE datagrams of several sizes, sent with the
+# don't-fragment bit from a separate socket, and asks for the largest payload that arrived
+MAX_DATAGRAM = 65507  # largest UDP payload over IPv4
+MAX_CHUNK_SIZE = MAX_DATAGRAM - PACKET_HEADER.size - 32
+PROBE_HEADER = struct.Struct("!5sI")  # b"PROBE", datagram size, then padding
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)  # Linux values, not always exported
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+MAX_MAPPINGS = 64  # served files kept memory-mapped; unused mappings beyond this are closed
+METRICS_BATCH = 64  # packets sent between metrics updates
+# Binary ACK: magic, transfer id, cumulative ack (every chunk below it was received),
+# file name length, SACK bitmap length, then the file name and the bitmap, whose
+# bit i (most significant first) is chunk cumulative + 1 + i
+ACK_HEADER = struct.Struct("!2sIQHH")
+ACK_MAGIC = b"\x00A"
+REQUEST_SIZE = 4096  # largest request read, a binary ACK with a full MAX_WINDOW bitmap is about 1.3 KB
 server = None
+probe_socket = None  # sends PROBE datagrams without fragmenting them
 running = True  
 
-def calculate_checksum(data):
-    """Calculate checksum of a packet using SHA256."""
-    return hashlib.sha256(data).digest()
+# Requests other than ACKs are handled by a fixed pool of threads, ACKs by the receiving loop.
+# Data packets of every transfer are sent by one sender thread, woken by timers and ACKs.
+WORKER_THREADS = 8
+WORKER_QUEUE = 256  # requests waiting per worker; more are dropped and the client asks again
 
-def mark_acknowledged(seq_num):
-    """Mark a sequence number as acknowledged."""
-    if seq_num not in ack:
-        ack.add(seq_num)
+# A transfer session per (client address, file, transfer id), holding what the client acknowledged
+MAX_SESSIONS = 1024  # the least recently used session is dropped beyond this
+SESSION_IDLE_TIMEOUT = 60.0  # seconds without a request before a session expires
 
-def send_chunks(client_address, filename, start_chunk, end_chunk):
-    """Send a specific range of file chunks to the client."""
-    file_path = os.path.join(SOURCE_FILE_PATH, filename)
+# Sliding-window sender: at most `cwnd` packets are in flight. The window grows with
+# each ACK (slow start, then +1 per RTT) and shrinks on loss (AIMD); sends are paced
+# over the smoothed RTT.
+INITIAL_WINDOW = 16  # packets
+MIN_WINDOW = 2
+MAX_WINDOW = 8192
+WINDOW_DECREASE = 0.5  # the window is multiplied by this on loss
+INITIAL_RTO = 0.5  # seconds before an unacknowledged packet counts as lost, until the RTT is known
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+REORDER_WINDOW = 0.25  # part of the RTT a packet may arrive late before a later ACK marks it lost
+PACING_SLACK = 0.001  # pacing only waits once it is this far ahead
+SEND_BURST = 32  # packets a transfer sends before the other transfers get their turn
+MAX_TIMEOUTS = 6  # a send gives up after this many RTOs in a row without an ACK...
+STALL_TIMEOUT = 5.0  # ...or after this long without an ACK
+RECEIVE_BUFFER = 4 * 1024 * 1024  # server socket receive buffer, ACKs dropped here look like losses
 
-    if not os.path.isfile(file_path):
-        server.sendto(b"ERROR: File not found", client_address)
-        return
+STATS_FILE = None  # if set, metrics are appended here as JSON lines
+STATS_INTERVAL = 10.0
+CLIENT_IDLE_TIMEOUT = 30.0  # a client counts as active this long after its last request
+RATE_WINDOW = 5
+LATENCY_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000]
+MAX_STATS_FILES = 20  # per-file counters in a STATS reply, which must fit in one datagram
 
-    try:
-        file_size = os.path.getsize(file_path)
-        with open(file_path, 'rb') as file:
-            for seq_num in range(start_chunk, end_chunk + 1):
-                if seq_num in ack:
+class Metrics:
+    """Server metrics: active clients, send rate, requests per file, latency and retransmits."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.last_seen = {}  # client address -> time of its last request
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.sent_per_second = deque()  # [second, bytes]
+        self.file_requests = Counter()
+        self.resend_requests = 0
+        self.retransmitted_packets = 0
+        self.dropped_requests = 0
+        self.latency = {}  # request type -> [count per bucket, total ms]
+
+    def client_seen(self, client_address):
+        with self.lock:
+            self.last_seen[client_address] = time.monotonic()
+
+    def add_sent(self, n, packets=1):
+        second = int(time.monotonic())
+        with self.lock:
+            self.bytes_sent += n
+            self.packets_sent += packets
+            if self.sent_per_second and self.sent_per_second[-1][0] == second:
+                self.sent_per_second[-1][1] += n
+            else:
+                self.sent_per_second.append([second, n])
+                while self.sent_per_second[0][0] <= second - RATE_WINDOW:
+                    self.sent_per_second.popleft()
+
+    def count_file(self, filename):
+        with self.lock:
+            self.file_requests[filename] += 1
+
+    def count_resend(self, packets):
+        with self.lock:
+            self.resend_requests += 1
+            self.retransmitted_packets += packets
+
+    def count_retransmitted(self, packets):
+        with self.lock:
+            self.retransmitted_packets += packets
+
+    def count_dropped(self):
+        with self.lock:
+            self.dropped_requests += 1
+
+    def observe(self, request_type, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            buckets, total = self.latency.get(request_type, ([0] * (len(LATENCY_BUCKETS_MS) + 1), 0.0))
+            index = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), len(LATENCY_BUCKETS_MS))
+            buckets[index] += 1
+            self.latency[request_type] = (buckets, total + ms)
+
+    def snapshot(self, max_files=None):
+        now = time.monotonic()
+        second = int(now)
+        with self.lock:
+            for address, seen in list(self.last_seen.items()):
+                if now - seen > CLIENT_IDLE_TIMEOUT:
+                    del self.last_seen[address]
+            recent = sum(n for s, n in self.sent_per_second if s > second - RATE_WINDOW)
+            return {
+                "time": time.time(),
+                "uptime": round(time.time() - self.started, 1),
+                "active_clients": len(self.last_seen),
+                "bytes_sent": self.bytes_sent,
+                "packets_sent": self.packets_sent,
+                "bytes_per_second": recent / RATE_WINDOW,
+                "resend_requests": self.resend_requests,
+                "retransmitted_packets": self.retransmitted_packets,
+                "dropped_requests": self.dropped_requests,
+                "sessions": len(sessions),
+                "file_requests": dict(self.file_requests.most_common(max_files)),
+                "latency": {
+                    request_type: {
+                        "count": sum(buckets),
+                        "avg_ms": round(total / sum(buckets), 3),
+                        "buckets_ms": dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ["inf"], buckets)),
+                    }
+                    for request_type, (buckets, total) in self.latency.items()
+                },
+            }
+
+    def dump(self, path, interval):
+        """Write a snapshot line to `path` every `interval` seconds."""
+        while running:
+            time.sleep(interval)
+            try:
+                with open(path, "a", encoding=FORMAT) as f:
+                    f.write(json.dumps(self.snapshot()) + "\n")
+            except OSError as e:
+                print(f"[ERROR] Unable to write stats: {e}")
+
+metrics = Metrics()
+
+manifest_cache = OrderedDict()  # file path -> (size, mtime, root, block hashes), least recently used first
+manifest_lock = threading.Lock()
+
+def merkle_root(hashes):
+    """Compute the Merkle root of a list of SHA-256 block hashes."""
+    if not hashes:
+        return hashlib.sha256(b"").digest()
+    level = list(hashes)
+    while len(level) > 1:
+        parents = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+def get_manifest(file_path):
+    """Return (size, mtime, root, hashes) of a file, rebuilt only when the file changed."""
+    st = os.stat(file_path)
+    with manifest_lock:
+        cached = manifest_cache.get(file_path)
+        if cached and cached[:2] == (st.st_size, st.st_mtime):
+            manifest_cache.move_to_end(file_path)
+            return cached
+    hashes = []
+    with open(file_path, 'rb') as file:
+        while block := file.read(MANIFEST_BLOCK):
+            hashes.append(hashlib.sha256(block).digest())
+    manifest = (st.st_size, st.st_mtime, merkle_root(hashes), hashes)
+    with manifest_lock:
+        manifest_cache[file_path] = manifest
+        manifest_cache.move_to_end(file_path)
+        while len(manifest_cache) > MAX_MANIFESTS:
+            manifest_cache.popitem(last=False)
+    return manifest
+
+class MappedFile:
+    """A served file mapped into memory, shared by all the sends of that file."""
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            st = os.fstat(file.fileno())
+            self.stamp = (st.st_size, st.st_mtime_ns)
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.size = st.st_size
+        self.refs = 0
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+class MappingCache:
+    """Memory-maps each served file once. A file that changed gets a new mapping;
+    the old one is closed once the sends still using it are done."""
+    def __init__(self, limit=MAX_MAPPINGS):
+        self.limit = limit
+        self.files = OrderedDict()  # path -> MappedFile, least recently used first
+        self.lock = threading.Lock()
+
+    def acquire(self, path):
+        st = os.stat(path)
+        with self.lock:
+            mapped = self.files.get(path)
+            if mapped is not None and mapped.stamp != (st.st_size, st.st_mtime_ns):
+                del self.files[path]
+                if not mapped.refs:
+                    mapped.close()
+                mapped = None
+            if mapped is None:
+                mapped = self.files[path] = MappedFile(path)
+                unused = [p for p, m in self.files.items() if not m.refs and p != path]
+                for stale in unused[:max(0, len(self.files) - self.limit)]:
+                    self.files.pop(stale).close()
+            self.files.move_to_end(path)
+            mapped.refs += 1
+            return mapped
+
+    def release(self, path, mapped):
+        with self.lock:
+            mapped.refs -= 1
+            if not mapped.refs and self.files.get(path) is not mapped:
+                mapped.close()
+
+mappings = MappingCache()
+
+def send_packet(parts, client_address):
+    """Send a datagram gathered from several buffers, without joining them where sendmsg exists."""
+    if hasattr(server, "sendmsg"):
+        return server.sendmsg(parts, [], 0, client_address)
+    return server.sendto(b"".join(parts), client_address)
+
+def packet_digest(mode, data):
+    """Digest of a packet payload for an integrity mode: nothing, CRC32 or SHA-256."""
+    if mode == INTEGRITY_MODES["crc32"]:
+        return struct.pack("!I", zlib.crc32(data))
+    if mode == INTEGRITY_MODES["sha256"]:
+        return hashlib.sha256(data).digest()
+    return b""
+
+class Session:
+    """State of one transfer: acknowledged chunks, packets in flight, RTT and congestion window."""
+    def __init__(self):
+        self.cumulative = 0  # every chunk below this was acknowledged
+        self.acked = set()  # chunks from `cumulative` on acknowledged selectively
+        self.last_seen = time.monotonic()
+        self.integrity = INTEGRITY_MODES["sha256"]
+        self.chunk_size = CHUNK_SIZE
+        self.lock = threading.Lock()
+        self.transfer = None  # the Transfer sending to this session, if any
+        self.in_flight = OrderedDict()  # seq -> (sent at, retransmitted), in send order
+        self.cwnd = INITIAL_WINDOW
+        self.ssthresh = MAX_WINDOW
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+        self.last_ack = time.monotonic()
+        self.timeouts = 0  # RTOs in a row without an ACK
+        self.delivered_sent = 0.0  # send time of the newest packet acknowledged
+        self.recovery_start = 0.0  # losses of packets sent before this were already counted
+
+    def negotiate(self, integrity, chunk_size):
+        """Take the integrity mode and chunk size a RANGE or RESEND asked for, if given."""
+        if integrity is not None:
+            allowed = integrity in ALLOWED_INTEGRITY and integrity in INTEGRITY_MODES
+            self.integrity = INTEGRITY_MODES[integrity if allowed else "sha256"]
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+    def is_acked(self, seq):
+        return seq < self.cumulative or seq in self.acked
+
+    def on_ack(self, cumulative, selective=()):
+        """Every chunk below `cumulative` and the `selective` ones were received."""
+        now = time.monotonic()
+        with self.lock:
+            self.last_ack = now
+            self.timeouts = 0
+            if cumulative > self.cumulative:
+                self.cumulative = cumulative
+                self.acked = {seq for seq in self.acked if seq >= cumulative}
+            self.acked.update(seq for seq in selective if seq >= self.cumulative)
+            delivered = [seq for seq in self.in_flight if self.is_acked(seq)]
+            if not delivered:
+                return
+            newest = None
+            for seq in delivered:
+                sent_at, retransmitted = self.in_flight.pop(seq)
+                if not retransmitted:
+                    # An ACK of a retransmitted packet could belong to either copy
+                    newest = sent_at if newest is None else max(newest, sent_at)
+                self.delivered_sent = max(self.delivered_sent, sent_at)
+                if self.cwnd < self.ssthresh:
+                    self.cwnd += 1
+                else:
+                    self.cwnd += 1 / self.cwnd
+            if newest is not None:
+                # The newest packet waited least for the batch to be sent
+                self.sample_rtt(now - newest)
+            self.cwnd = min(self.cwnd, MAX_WINDOW)
+            transfer = self.transfer
+        if transfer is not None:
+            # Room in the window, or packets to count as lost
+            sender.schedule(transfer, now)
+
+    def sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def detect_losses(self, now):
+        """Take the packets presumed lost out of flight and shrink the window. Caller holds self.lock.
+
+        A packet is lost if one sent after it was acknowledged more than a
+        reorder window later, or if it is unacknowledged after the RTO.
+        """
+        reorder = REORDER_WINDOW * (self.srtt or self.rto)
+        lost = []
+        for seq, (sent_at, _) in self.in_flight.items():
+            if sent_at >= self.delivered_sent - reorder and now - sent_at <= self.rto:
+                break
+            lost.append(seq)
+        if not lost:
+            return lost
+        newest_lost = self.in_flight[lost[-1]][0]
+        for seq in lost:
+            del self.in_flight[seq]
+        if now - self.last_ack > self.rto:
+            # Nothing got through for a whole RTO, start over from a small window
+            self.ssthresh = max(MIN_WINDOW, self.cwnd * WINDOW_DECREASE)
+            self.cwnd = MIN_WINDOW
+            self.rto = min(MAX_RTO, self.rto * 2)
+            self.timeouts += 1
+            self.recovery_start = now
+        elif newest_lost >= self.recovery_start:
+            # One decrease per window of losses
+            self.ssthresh = self.cwnd = max(MIN_WINDOW, self.cwnd * WINDOW_DECREASE)
+            self.recovery_start = now
+        return lost
+
+class SessionTable:
+    """Transfer sessions keyed by (client address, file, transfer id), least recently used first."""
+    def __init__(self, limit=MAX_SESSIONS, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.limit = limit
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, create=True):
+        """The session for `key`, a new one if `create`, else None if there is none."""
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None:
+                self.sessions.move_to_end(key)
+            elif create:
+                self.expire(now)
+                while len(self.sessions) >= self.limit:
+                    self.sessions.popitem(last=False)
+                session = self.sessions[key] = Session()
+            else:
+                return None
+        session.last_seen = now
+        return session
+
+    def expire(self, now):
+        while self.sessions:
+            key, session = next(iter(self.sessions.items()))
+            if now - session.last_seen <= self.idle_timeout:
+                break
+            del self.sessions[key]
+
+    def __len__(self):
+        return len(self.sessions)
+
+sessions = SessionTable()
+
+class Transfer:
+    """Chunks of one file being sent to a session, within its congestion window.
+
+    Run by the sender thread whenever it is due: when pacing allows the next
+    packet, when an ACK arrived, or when the oldest packet in flight times out.
+    """
+    def __init__(self, session, client_address, file_path, mapped, resend=False):
+        self.session = session
+        self.client_address = client_address
+        self.file_path = file_path
+        self.mapped = mapped
+        self.resend = resend  # every packet counts as retransmitted
+        self.fresh = deque()  # iterators over the chunk ranges asked for
+        self.lost = deque()
+        self.seq_num = None  # next chunk to send, waiting for room in the window
+        self.is_retransmit = False
+        self.next_send = time.monotonic()
+        self.due = None  # when the sender runs it next
+        self.done = False
+        self.header = bytearray(PACKET_HEADER.size)  # reused by every packet
+        self.retransmitted = 0
+        self.sent_bytes = self.sent_packets = 0  # not yet added to the metrics
+
+    def add(self, start_chunk, end_chunk):
+        """Also send chunks start_chunk..end_chunk. Caller holds the session's lock."""
+        end_chunk = min(end_chunk, (self.mapped.size - 1) // self.session.chunk_size)
+        self.fresh.append(iter(range(start_chunk, end_chunk + 1)))
+
+    def next_chunk(self):
+        """(seq, retransmit) of the next chunk to send: lost ones first, then the ranges asked for.
+
+        The seq is None once every chunk was sent.
+        """
+        session = self.session
+        while self.lost:
+            seq_num = self.lost.popleft()
+            if not session.is_acked(seq_num):
+                return seq_num, True
+        while self.fresh:
+            for seq_num in self.fresh[0]:
+                # A range added by a RESEND may cover chunks still in flight
+                if not session.is_acked(seq_num) and seq_num not in session.in_flight:
+                    return seq_num, False
+            self.fresh.popleft()
+        return None, False
+
+    def run(self, now):
+        """Send up to SEND_BURST packets. Returns when to run again, or None once done.
+
+        Done once every chunk was acknowledged, or once the client went silent: it
+        is gone, stopped or has the rest but its last ACKs were lost, and asks again
+        with RESEND if needed.
+        """
+        session = self.session
+        chunk_size = session.chunk_size
+        for _ in range(SEND_BURST):
+            with session.lock:
+                if session.transfer is not self:
+                    # Replaced by a transfer of the file as it is now
+                    self.done = True
+                    return None
+                self.lost.extend(session.detect_losses(now))
+                if self.seq_num is None or session.is_acked(self.seq_num):
+                    self.seq_num, self.is_retransmit = self.next_chunk()
+                if (self.seq_num is None and not session.in_flight
+                        or session.timeouts >= MAX_TIMEOUTS or now - session.last_ack > STALL_TIMEOUT):
+                    self.stop()
+                    return None
+                if self.seq_num is None or len(session.in_flight) >= session.cwnd:
+                    # Woken by an ACK, or when the oldest packet in flight times out
+                    oldest = next(iter(session.in_flight.values()))[0]
+                    return min(oldest + session.rto, session.last_ack + STALL_TIMEOUT) + PACING_SLACK
+                if self.next_send > now + PACING_SLACK:
+                    return self.next_send
+                session.in_flight[self.seq_num] = (now, self.is_retransmit)
+                gap = session.srtt / session.cwnd if session.srtt else 0.0
+                integrity = session.integrity
+            self.next_send = max(self.next_send, now) + gap
+
+            offset = self.seq_num * chunk_size
+            PACKET_HEADER.pack_into(self.header, 0, self.seq_num, integrity)
+            with self.mapped.view[offset:offset + chunk_size] as data:
+                self.sent_bytes += send_packet((self.header, packet_digest(integrity, data), data), self.client_address)
+            self.sent_packets += 1
+            if self.sent_packets == METRICS_BATCH:
+                metrics.add_sent(self.sent_bytes, self.sent_packets)
+                self.sent_bytes = self.sent_packets = 0
+            if self.is_retransmit or self.resend:
+                self.retransmitted += 1
+            self.seq_num = None
+            now = time.monotonic()
+        return now  # the other transfers due now go first
+
+    def stop(self):
+        """Take the transfer off its session. Caller holds the session's lock."""
+        self.done = True
+        if self.session.transfer is self:
+            self.session.in_flight.clear()
+            self.session.transfer = None
+
+    def close(self):
+        mappings.release(self.file_path, self.mapped)
+        if self.sent_packets:
+            metrics.add_sent(self.sent_bytes, self.sent_packets)
+        if self.retransmitted:
+            metrics.count_retransmitted(self.retransmitted)
+
+class Sender:
+    """Runs every active transfer from one thread, each when it is due.
+
+    Transfers never block, so a client that stops acknowledging only holds up
+    its own transfer until it times out.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.timers = []  # heap of (due, tie breaker, transfer)
+        self.order = itertools.count()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def schedule(self, transfer, due):
+        """Run `transfer` at `due` at the latest."""
+        with self.cond:
+            if transfer.due is not None and transfer.due <= due:
+                return
+            transfer.due = due
+            heapq.heappush(self.timers, (due, next(self.order), transfer))
+            if self.timers[0][2] is transfer:
+                self.cond.notify()
+
+    def work(self):
+        while running:
+            with self.cond:
+                now = time.monotonic()
+                if not self.timers or self.timers[0][0] > now:
+                    self.cond.wait(self.timers[0][0] - now if self.timers else 1.0)
                     continue
+                due, _, transfer = heapq.heappop(self.timers)
+                if transfer.done or transfer.due != due:
+                    continue  # finished, or rescheduled earlier and already run
+                transfer.due = None
+            try:
+                due = transfer.run(time.monotonic())
+            except Exception as e:
+                print(f"[ERROR] Failed to send chunks: {e}")
+                with transfer.session.lock:
+                    transfer.stop()
+                due = None
+            if due is None:
+                transfer.close()
+            else:
+                self.schedule(transfer, due)
 
-                file.seek(seq_num * CHUNK_SIZE)
-                data = file.read(min(CHUNK_SIZE, file_size - seq_num * CHUNK_SIZE))
-                checksum = calculate_checksum(data)
+sender = Sender()
 
-                packet = struct.pack('I', seq_num) + checksum + data
-                server.sendto(packet, client_address)
+def send_chunks(client_address, filename, start_chunk, end_chunk, session, resend=False):
+    """Have the chunks of a range that `session` has not acknowledged yet sent by the sender thread.
 
-                if seq_num % 10 == 0:
-                    time.sleep(0.0001)
-    except Exception as e:
-        print(f"[ERROR] Failed to send chunks: {e}")
+    The range joins the transfer already sending to the session, if any.
+    Returns False if the file does not exist.
+    """
+    file_path = os.path.join(SOURCE_FILE_PATH, filename)
+
+    if not os.path.isfile(file_path):
+        server.sendto(b"ERROR: File not found", client_address)
+        return False
+    if os.path.getsize(file_path) == 0:
+        return True
+    mapped = mappings.acquire(file_path)
+    with session.lock:
+        transfer = session.transfer
+        if transfer is None or transfer.mapped is not mapped:
+            if transfer is not None:
+                # The file changed, the old transfer stops at its next run
+                transfer.fresh.clear()
+                transfer.lost.clear()
+            transfer = session.transfer = Transfer(session, client_address, file_path, mapped, resend)
+            session.last_ack = time.monotonic()
+            session.timeouts = 0
+        else:
+            mappings.release(file_path, mapped)
+        transfer.add(start_chunk, end_chunk)
+    sender.schedule(transfer, time.monotonic())
+    return True
 
 def handle_client_request(client_address, request):
     """Process the client's request."""
+    start = time.perf_counter()
+    request_type = "invalid"
     try:
+        metrics.client_seen(client_address)
+        if request.startswith(ACK_MAGIC):
+            request_type = "ack"
+            handle_sack(client_address, request)
+            metrics.observe(request_type, time.perf_counter() - start)
+            return
         request_data = request.decode().split(':')
 
         if request_data == ["[LIST]"]:
+            request_type = "list"
             handle_list_request(client_address)
+        elif request_data == ["STATS"] and not os.path.isfile(os.path.join(SOURCE_FILE_PATH, "STATS")):
+            # A served file named STATS keeps its size request
+            request_type = "stats"
+            handle_stats_request(client_address)
         elif len(request_data) == 1:
+            request_type = "size"
             handle_file_request(client_address, request_data[0])
         elif request_data[0] == "RANGE":
+            request_type = "range"
             handle_range_request(client_address, request_data)
+        elif request_data[0] == "STAT":
+            request_type = "stat"
+            handle_stat_request(client_address, request_data)
+        elif request_data[0] == "PROBE":
+            request_type = "probe"
+            handle_probe_request(client_address, request_data)
+        elif request_data[0] == "MANIFEST":
+            request_type = "manifest"
+            handle_manifest_request(client_address, request_data)
         elif request_data[0] == "RESEND":
+            request_type = "resend"
             handle_resend_request(client_address, request_data)
         elif request_data[0] == "ACK":
-            handle_ack_request(request_data)
+            request_type = "ack"
+            handle_ack_request(client_address, request_data)
         else:
             server.sendto(b"ERROR: Invalid request", client_address)
     except Exception as e:
         print(f"[ERROR] Error processing request from {client_address}: {e}")
+    metrics.observe(request_type, time.perf_counter() - start)
 
 import json
 
@@ -115,8 +697,14 @@ def handle_list_request(client_address):
         print(f"[ERROR] Unable to fetch file list: {e}")
         server.sendto(b"ERROR: Unable to fetch file list", client_address)
 
+def handle_stats_request(client_address):
+    """Handle the 'STATS' request."""
+    stats = json.dumps(metrics.snapshot(MAX_STATS_FILES)).encode(FORMAT)
+    server.sendto(stats, client_address)
+
 def handle_file_request(client_address, filename):
     """Handle a file request."""
+    metrics.count_file(filename)
     file_path = os.path.join(SOURCE_FILE_PATH, filename)
     try:
         if os.path.isfile(file_path):
@@ -130,13 +718,44 @@ def handle_file_request(client_address, filename):
     except Exception as e:
         print(f"[ERROR] Failed to process file request for {filename}: {e}")
         server.sendto(f"ERROR: Failed to process file request".encode(FORMAT), client_address)
-    ack.clear()
+
+def handle_stat_request(client_address, request_data):
+    """Handle the 'STAT' request: size and mtime of a file, to validate resumed downloads."""
+    filename = request_data[1] if len(request_data) == 2 else ""
+    metrics.count_file(filename)
+    file_path = os.path.join(SOURCE_FILE_PATH, filename)
+    if os.path.isfile(file_path):
+        st = os.stat(file_path)
+        server.sendto(f"{st.st_size}:{st.st_mtime!r}".encode(FORMAT), client_address)
+    else:
+        server.sendto(f"ERROR: File not found: {filename}".encode(FORMAT), client_address)
+
+def parse_range(request_data):
+    """(filename, start chunk, end chunk, transfer id, integrity mode, chunk size) of a RANGE or RESEND request.
+
+    Requests without a transfer id belong to transfer 0; the integrity mode and
+    chunk size are None if not given.
+    """
+    _, filename, start_chunk, end_chunk, *options = request_data
+    if len(options) > 3:
+        raise ValueError("too many fields")
+    transfer_id = int(options[0]) if options else 0
+    integrity = options[1] if len(options) > 1 else None
+    chunk_size = int(options[2]) if len(options) > 2 else None
+    if chunk_size is not None and not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError(f"chunk size {chunk_size} out of range")
+    start_chunk, end_chunk = int(start_chunk), int(end_chunk)
+    if start_chunk < 0 or end_chunk < start_chunk:
+        raise ValueError(f"chunks {start_chunk} to {end_chunk} out of range")
+    return filename, start_chunk, end_chunk, transfer_id, integrity, chunk_size
 
 def handle_range_request(client_address, request_data):
     """Handle the 'RANGE' request."""
     try:
-        _, filename, start_chunk, end_chunk = request_data
-        send_chunks(client_address, filename, int(start_chunk), int(end_chunk))
+        filename, start_chunk, end_chunk, transfer_id, integrity, chunk_size = parse_range(request_data)
+        session = sessions.get((client_address, filename, transfer_id))
+        session.negotiate(integrity, chunk_size)
+        send_chunks(client_address, filename, start_chunk, end_chunk, session)
     except ValueError as e:
         print(f"[ERROR] Invalid range request: {request_data}")
         server.sendto(b"ERROR: Invalid range request", client_address)
@@ -144,43 +763,148 @@ def handle_range_request(client_address, request_data):
 def handle_resend_request(client_address, request_data):
     """Handle the 'RESEND' request."""
     try:
-        _, filename, start_chunk, end_chunk = request_data
-        send_chunks(client_address, filename, int(start_chunk), int(end_chunk))
+        filename, start_chunk, end_chunk, transfer_id, integrity, chunk_size = parse_range(request_data)
+        session = sessions.get((client_address, filename, transfer_id))
+        # Repeats what the RANGE asked for, in case the RANGE was lost
+        session.negotiate(integrity, chunk_size)
+        if send_chunks(client_address, filename, start_chunk, end_chunk, session, resend=True):
+            metrics.count_resend(0)
     except ValueError as e:
         print(f"[ERROR] Invalid resend request: {request_data}")
         server.sendto(b"ERROR: Invalid resend request", client_address)
 
-def handle_ack_request(request_data):
-    """Handle the 'ACK' request."""
+def handle_probe_request(client_address, request_data):
+    """Handle the 'PROBE' request: one datagram of each size asked for, sizes the path can't carry are skipped."""
+    try:
+        _, sizes = request_data
+        sizes = [int(size) for size in sizes.split(",")]
+    except ValueError:
+        server.sendto(b"ERROR: Invalid probe request", client_address)
+        return
+    for size in sizes:
+        if PROBE_HEADER.size <= size <= MAX_DATAGRAM:
+            try:
+                probe_socket.sendto(PROBE_HEADER.pack(b"PROBE", size).ljust(size, b"\0"), client_address)
+            except OSError:
+                pass  # larger than the path MTU known here
+
+def handle_manifest_request(client_address, request_data):
+    """Handle the 'MANIFEST' request: one page of block hashes of a file in a datagram of at most page size bytes."""
+    try:
+        _, filename, first_block, *page_size = request_data
+        first_block = int(first_block)
+        page_size = int(page_size[0]) if page_size else CHUNK_SIZE
+        # At least one hash per page, so a tiny page size still makes progress
+        per_page = min(MANIFEST_PAGE, max(1, (page_size - MANIFEST_HEADER.size - 32) // 32))
+        file_path = os.path.join(SOURCE_FILE_PATH, filename)
+        if not os.path.isfile(file_path):
+            server.sendto(f"ERROR: File not found: {filename}".encode(FORMAT), client_address)
+            return
+        metrics.count_file(filename)
+        size, mtime, root, hashes = get_manifest(file_path)
+        page = hashes[first_block:first_block + per_page]
+        header = MANIFEST_HEADER.pack(size, mtime, MANIFEST_BLOCK, len(hashes), first_block)
+        server.sendto(header + root + b"".join(page), client_address)
+    except ValueError:
+        print(f"[ERROR] Invalid manifest request: {request_data}")
+        server.sendto(b"ERROR: Invalid manifest request", client_address)
+
+def handle_ack_request(client_address, request_data):
+    """Handle the 'ACK' request: ACK:filename:transfer id:seq."""
     try:
-        _, seq_num = request_data
-        mark_acknowledged(int(seq_num))
+        _, filename, transfer_id, seq_num = request_data
+        # ACKs of an expired session are ignored; the next request starts a new one
+        session = sessions.get((client_address, filename, int(transfer_id)), create=False)
+        if session is not None:
+            session.on_ack(0, (int(seq_num),))
     except ValueError as e:
         print(f"[ERROR] Invalid ACK request: {request_data}")
 
+def handle_sack(client_address, request):
+    """Handle a binary ACK: a cumulative ACK and a bitmap of the chunks received after it."""
+    try:
+        _, transfer_id, cumulative, name_length, bitmap_length = ACK_HEADER.unpack_from(request)
+        start = ACK_HEADER.size
+        filename = request[start:start + name_length].decode(FORMAT)
+        bitmap = request[start + name_length:start + name_length + bitmap_length]
+    except (struct.error, UnicodeDecodeError):
+        print(f"[ERROR] Invalid binary ACK from {client_address}")
+        return
+    session = sessions.get((client_address, filename, transfer_id), create=False)
+    if session is None:
+        return
+    selective = [cumulative + 1 + index * 8 + bit
+                 for index, byte in enumerate(bitmap) if byte
+                 for bit in range(8) if byte & 0x80 >> bit]
+    session.on_ack(cumulative, selective)
+
+class Dispatcher:
+    """Hands requests to a fixed pool of worker threads.
+
+    All requests from one client socket go to the same worker, so they are
+    handled in order and one busy client only holds up its own worker.
+    """
+    def __init__(self, count=WORKER_THREADS, depth=WORKER_QUEUE):
+        self.queues = [queue.Queue(depth) for _ in range(count)]
+        for requests in self.queues:
+            threading.Thread(target=self.work, args=(requests,), daemon=True).start()
+
+    def dispatch(self, client_address, request):
+        requests = self.queues[hash(client_address) % len(self.queues)]
+        try:
+            requests.put_nowait((client_address, request))
+        except queue.Full:
+            metrics.count_dropped()
+
+    def work(self, requests):
+        while True:
+            item = requests.get()
+            if item is None:
+                return
+            handle_client_request(*item)
+
+    def stop(self):
+        for requests in self.queues:
+            requests.put(None)
+
 def start_server():
     """Initialize and start the UDP server."""
     global running
     global server
+    global probe_socket
 
     print("[STARTING] Server is starting...")
     print(f"[LISTENING] Server running on {SERVER}:{PORT}")
     server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
     server.bind(ADDR)
+    # Only probes go out with don't-fragment set: datagrams larger than the path MTU
+    # fail instead, which is what PROBE relies on. Replies on `server` may still be fragmented.
+    probe_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if sys.platform.startswith("linux"):
+        probe_socket.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
     server.settimeout(1.0)
 
     connected_clients = set()  
+    dispatcher = Dispatcher()
+    sender.start()
+    if STATS_FILE:
+        threading.Thread(target=metrics.dump, args=(STATS_FILE, STATS_INTERVAL), daemon=True).start()
 
     try:
         while running:
             try:
-                request, client_address = server.recvfrom(1024)
+                request, client_address = server.recvfrom(REQUEST_SIZE)
                 client_ip = client_address[0]  
                 if client_ip not in connected_clients:
                     connected_clients.add(client_ip)
                     print(f"[CONNECTION] New client connected: {client_ip}")
 
-                threading.Thread(target=handle_client_request, args=(client_address, request)).start()
+                if request.startswith(b"ACK:") or request.startswith(ACK_MAGIC):
+                    # Only marks chunks as received, cheaper than handing it to a worker
+                    handle_client_request(client_address, request)
+                else:
+                    dispatcher.dispatch(client_address, request)
             except socket.timeout:
                 continue
             except socket.error as e:
@@ -190,11 +914,23 @@ def start_server():
     except Exception as e:
         print(f"[ERROR] Server error: {e}")
     finally:
+        dispatcher.stop()
         if server:
             server.close()
+        if probe_socket:
+            probe_socket.close()
         print("[CLEANUP] Server resources released.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP file server")
+    parser.add_argument("--stats-file", default=STATS_FILE,
+                        help="append metrics as JSON lines to this file")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="seconds between two lines of --stats-file (default: %(default)s)")
+    args = parser.parse_args()
+    STATS_FILE = args.stats_file
+    STATS_INTERVAL = args.stats_interval
+
     try:
         running = True  
         start_server()
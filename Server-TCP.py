@@ -1,6 +1,20 @@
 import socket
 import threading
+import selectors
+import argparse
 import os
+import errno
+import struct
+import stat
+import time
+import zlib
+import bz2
+import lzma
+import signal
+import json
+import hashlib
+from collections import deque, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
 
 # Server Configuration
 PORT = 8080
@@ -9,10 +23,95 @@ ADDR = (HOST, PORT)
 FORMAT = 'utf-8'
 FILE_LIST_PATH = os.path.dirname(__file__)  
 FILE_FOLDER_PATH = os.path.join(FILE_LIST_PATH, "files_from_server")
-unit = 4096
+unit = 1024 * 1024  # block size for the buffered fallback
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(ADDR)
+# Serve ranges with os.sendfile (zero-copy) when the platform supports it
+USE_SENDFILE = hasattr(os, "sendfile")
+SENDFILE_FALLBACK_ERRNOS = {errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP}
+
+# Server engine: "threaded" (one thread per connection) or "selectors" (single event loop)
+SERVER_MODE = "threaded"
+MAX_CONNECTIONS = 1024  # selectors mode: stop accepting above this many clients
+STREAM_BLOCK = 64 * 1024  # selectors mode: max bytes buffered per connection
+OFFLOAD_THREADS = 4  # selectors mode: threads compressing blocks and hashing files off the event loop
+
+# Binary framing: a client switches to it by sending a HELLO frame as its first request.
+# Header: magic, version, opcode, flags, request id, payload length
+FRAME_MAGIC = b"\x00F"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBHIQ")
+RANGE_REQUEST = struct.Struct("!QQ")  # offset, length (followed by the filename)
+SIZE_RESPONSE = struct.Struct("!Q")
+STAT_RESPONSE = struct.Struct("!Qd")  # size, mtime
+OP_HELLO = 0
+OP_LIST = 1
+OP_SIZE = 2
+OP_RANGE = 3
+OP_RANGES = 4  # payload: name length (H), filename, then (offset, length) pairs
+OP_ZRANGE = 5  # compressed range, answered with one frame per block
+OP_STATS = 6  # server metrics as JSON
+OP_MANIFEST = 7  # block hashes and Merkle root of a file
+OP_STAT = 8  # size and mtime of a file, used by clients to validate resumed downloads
+OP_ERROR = 255
+FLAG_MORE = 1  # more frames follow for the same request
+RANGES_HEADER = struct.Struct("!H")
+RANGE_LENGTH = struct.Struct("!Q")
+MAX_REQUEST_PAYLOAD = 4096  # largest request frame payload accepted
+MAX_PIPELINE = 64  # selectors mode: max queued responses per framed connection
+
+# Compression, negotiated in HELLO: the client sends the codecs it supports,
+# the server answers with the block size and the first codec of this list it shares
+COMPRESSION_CODECS = ["zlib", "bz2", "lzma"]
+COMPRESSORS = {"zlib": zlib.compress, "bz2": bz2.compress, "lzma": lzma.compress}
+COMPRESS_BLOCK = 256 * 1024  # files are compressed in independent blocks of this size
+COMPRESS_CACHE_BYTES = 64 * 1024 * 1024  # memory used by cached compressed blocks
+COMPRESS_MIN_SAVING = 0.1  # blocks compressing by less than this are sent as they are
+BLOCK_ENTRY_COST = 256  # bytes counted per cached block on top of its data, for its key and entry
+HELLO_RESPONSE = struct.Struct("!I")  # block size (followed by the codec name)
+BLOCK_HEADER = struct.Struct("!QIB")  # raw offset, raw length, method
+BLOCK_STORED = 0
+BLOCK_COMPRESSED = 1
+
+# Bandwidth scheduling, in bytes per second (0 = unlimited): a global cap and a cap
+# per client IP. Clients waiting for bandwidth are served by deficit round robin.
+GLOBAL_RATE = 0
+CLIENT_RATE = 0
+SCHEDULER_QUANTUM = 64 * 1024  # bytes a client may send per round robin turn
+SCHEDULER_TICK = 0.01  # selectors mode: seconds between retries of throttled clients
+
+# File catalog: metadata cached in memory, refreshed by polling the folder
+CATALOG_POLL_INTERVAL = 2.0  # seconds between two scans of FILE_FOLDER_PATH
+MAX_OPEN_FILES = 64  # open file descriptors kept in the LRU cache
+
+# Metrics, reported by the STATS command and optionally appended as JSON lines
+# to STATS_FILE every STATS_INTERVAL seconds (--stats-file, --stats-interval)
+STATS_FILE = None
+STATS_INTERVAL = 10.0
+RATE_WINDOW = 5  # seconds over which the send rate is averaged
+LATENCY_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000]
+FRAME_COMMANDS = {OP_HELLO: "hello", OP_LIST: "list", OP_SIZE: "size", OP_RANGE: "range",
+                  OP_RANGES: "ranges", OP_ZRANGE: "zrange", OP_STATS: "stats", OP_MANIFEST: "manifest",
+                  OP_STAT: "stat"}
+
+# Manifests: SHA-256 of every MANIFEST_BLOCK bytes of a file plus their Merkle root.
+# Encoded as MANIFEST_HEADER (size, mtime, block size, block count), root, block hashes.
+MANIFEST_BLOCK = 1024 * 1024
+MANIFEST_HEADER = struct.Struct("!QdII")
+MAX_MANIFESTS = 256  # manifests kept in memory
+
+# Worker processes (--workers). More than one needs os.fork; each worker binds ADDR
+# with SO_REUSEPORT where available, otherwise they share the parent's listening socket
+WORKERS = 1
+WORKER_RESTART_DELAY = 1.0  # seconds to wait before restarting a worker that died young
+
+server = None
+
+def create_server_socket(reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(ADDR)
+    return sock
 
 def read_file_list(filename):
     if not os.path.exists(filename):
@@ -25,60 +124,1224 @@ def read_file_list(filename):
         print(f"Error: Cannot read file: {e}")
         return "Error: Cannot read file list."
 
+class CatalogEntry:
+    """Cached metadata of one file in FILE_FOLDER_PATH."""
+    def __init__(self, name, path, size, mtime, inode=0):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+
+class OpenFile:
+    """A shared read-only descriptor, safe to use from several threads."""
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        self.refs = 0
+        self.evicted = False
+        self.lock = threading.Lock()  # only used where os.pread is missing
+
+    def fileno(self):
+        return self.fd
+
+    def read_at(self, offset, size):
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+class FileCatalog:
+    """In-memory view of the served folder and of file_list.txt.
+
+    Sizes and mtimes are refreshed every CATALOG_POLL_INTERVAL seconds and
+    open descriptors are kept in an LRU cache, so requests don't stat or open files.
+    """
+    def __init__(self, folder, list_path, max_open_files=MAX_OPEN_FILES):
+        self.folder = folder
+        self.list_path = list_path
+        self.max_open_files = max_open_files
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.listing = b""  # file_list.txt, already encoded for sending
+        self.listing_mtime = None
+        self.open_files = OrderedDict()  # path -> OpenFile, least recently used first
+        self.refresh()
+
+    def refresh(self):
+        """Rescan the folder and file_list.txt, dropping cached data of changed files."""
+        entries = {}
+        try:
+            with os.scandir(self.folder) as it:
+                for item in it:
+                    if item.is_file():
+                        st = item.stat()
+                        entries[item.name] = CatalogEntry(item.name, item.path, st.st_size, st.st_mtime, st.st_ino)
+        except FileNotFoundError:
+            pass
+
+        try:
+            listing_mtime = os.stat(self.list_path).st_mtime
+        except OSError:
+            listing_mtime = None
+        if listing_mtime != self.listing_mtime or not self.listing:
+            listing = read_file_list(self.list_path).encode(FORMAT)
+        else:
+            listing = self.listing
+
+        with self.lock:
+            for name, old in self.entries.items():
+                new = entries.get(name)
+                if new is None or (new.size, new.mtime) != (old.size, old.mtime):
+                    self.evict(old.path)
+            self.entries = entries
+            self.listing = listing
+            self.listing_mtime = listing_mtime
+
+    def get(self, name):
+        """Return the CatalogEntry of `name`, or None if the file doesn't exist."""
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is not None:
+            return entry
+        # Not seen by the last scan, the file may have been added since
+        path = os.path.join(self.folder, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        entry = CatalogEntry(name, path, st.st_size, st.st_mtime, st.st_ino)
+        if os.path.dirname(name) == "":
+            with self.lock:
+                self.entries[name] = entry
+        return entry
+
+    def acquire(self, path):
+        """Return a cached OpenFile for `path`. Must be given back with release()."""
+        with self.lock:
+            f = self.open_files.get(path)
+            if f is None:
+                f = OpenFile(path)
+                self.open_files[path] = f
+                while len(self.open_files) > self.max_open_files:
+                    self.evict(next(iter(self.open_files)))
+            else:
+                self.open_files.move_to_end(path)
+            f.refs += 1
+            return f
+
+    def release(self, f):
+        with self.lock:
+            f.refs -= 1
+            if f.evicted and f.refs == 0:
+                os.close(f.fd)
+
+    def evict(self, path):
+        # Caller holds self.lock. Files still in use are closed by their last release()
+        f = self.open_files.pop(path, None)
+        if f is not None:
+            f.evicted = True
+            if f.refs == 0:
+                os.close(f.fd)
+
+    def watch(self, interval=CATALOG_POLL_INTERVAL):
+        """Refresh the catalog forever, meant to run in a daemon thread."""
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing file catalog: {e}")
+
+# Loaded at import, before workers fork, so they start from the same catalog
+catalog = FileCatalog(FILE_FOLDER_PATH, os.path.join(FILE_LIST_PATH, "file_list.txt"))
+
+class TokenBucket:
+    """Refills at `rate` bytes per second, holding at most `capacity` bytes."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, size):
+        """Seconds until `size` bytes are available."""
+        return max(0.0, (size - self.tokens) / self.rate)
+
+class BandwidthRequest:
+    """A request to send `size` bytes, granted by the BandwidthScheduler."""
+    def __init__(self, flow, size):
+        self.flow = flow
+        self.size = size
+        self.granted = False
+
+class ClientFlow:
+    """Scheduler state of one client IP, shared by all its connections."""
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.deficit = 0
+        self.topped_up = False  # got its quantum for the current turn
+        self.waiting = deque()  # BandwidthRequests not granted yet
+
+class BandwidthScheduler:
+    """Shares the server bandwidth fairly between client IPs.
+
+    Requests wait in a queue per client IP. Clients with waiting requests are
+    served by deficit round robin, under a global and a per-client token bucket,
+    so parallel connections from one client share that client's share.
+    """
+    def __init__(self, global_rate=GLOBAL_RATE, client_rate=CLIENT_RATE, quantum=SCHEDULER_QUANTUM):
+        self.quantum = quantum
+        self.client_rate = client_rate
+        self.global_bucket = self.make_bucket(global_rate)
+        self.flows = {}  # client IP -> ClientFlow
+        self.ring = deque()  # flows with waiting requests, in round robin order
+        self.cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return bool(self.global_bucket or self.client_rate)
+
+    def make_bucket(self, rate):
+        # Small bursts only, but always room for one quantum
+        return TokenBucket(rate, max(self.quantum, rate / 20)) if rate else None
+
+    def submit(self, ip, size):
+        """Queue a request for `size` bytes (at most one quantum). Caller holds self.cond."""
+        flow = self.flows.get(ip)
+        if flow is None:
+            flow = self.flows[ip] = ClientFlow(self.make_bucket(self.client_rate))
+        request = BandwidthRequest(flow, min(size, self.quantum))
+        if not flow.waiting:
+            self.ring.append(flow)
+        flow.waiting.append(request)
+        return request
+
+    def schedule(self):
+        """Grant waiting requests. Caller holds self.cond.
+
+        Returns the seconds to wait before tokens allow more grants, or None if
+        no request is waiting anymore.
+        """
+        now = time.monotonic()
+        if self.global_bucket:
+            self.global_bucket.refill(now)
+        granted = False
+        blocked = 0  # flows in a row held back by their own bucket
+        delay = None
+        while self.ring and blocked < len(self.ring):
+            flow = self.ring[0]
+            if not flow.topped_up:
+                flow.deficit += self.quantum
+                flow.topped_up = True
+            if flow.bucket:
+                flow.bucket.refill(now)
+
+            held = False
+            while flow.waiting and flow.waiting[0].size <= flow.deficit:
+                request = flow.waiting[0]
+                if self.global_bucket and self.global_bucket.tokens < request.size:
+                    if granted:
+                        self.cond.notify_all()
+                    return self.global_bucket.delay(request.size)
+                if flow.bucket and flow.bucket.tokens < request.size:
+                    held = True
+                    wait = flow.bucket.delay(request.size)
+                    delay = wait if delay is None else min(delay, wait)
+                    break
+                if self.global_bucket:
+                    self.global_bucket.tokens -= request.size
+                if flow.bucket:
+                    flow.bucket.tokens -= request.size
+                flow.deficit -= request.size
+                flow.waiting.popleft()
+                request.granted = True
+                granted = True
+
+            if not flow.waiting:
+                flow.deficit = 0
+                flow.topped_up = False
+                self.ring.popleft()
+                blocked = 0
+                continue
+            if held:
+                blocked += 1  # keeps its deficit until its bucket refills
+            else:
+                flow.topped_up = False
+                blocked = 0
+            self.ring.rotate(-1)
+
+        if granted:
+            self.cond.notify_all()
+        return delay
+
+    def cancel(self, request):
+        """Drop a request that will not be used. Caller holds self.cond."""
+        flow = request.flow
+        if request in flow.waiting:
+            flow.waiting.remove(request)
+            if not flow.waiting:
+                flow.deficit = 0
+                flow.topped_up = False
+                self.ring.remove(flow)
+
+    def acquire(self, ip, size):
+        """Block until `ip` may send `size` more bytes."""
+        with self.cond:
+            while size > 0:
+                request = self.submit(ip, size)
+                while not request.granted:
+                    delay = self.schedule()
+                    if not request.granted:
+                        self.cond.wait(delay)
+                size -= request.size
+
+scheduler = BandwidthScheduler()  # replaced with the command line rates in __main__
+
+def buffered_range(conn, f, offset, length, throttle=None):
+    """Send a file range by reading it block by block. Returns the number of bytes sent."""
+    sent = 0
+    while sent < length:
+        chunk = f.read_at(offset + sent, min(unit, length - sent))
+        if not chunk:
+            break
+        if throttle:
+            throttle(len(chunk))
+        conn.sendall(chunk)
+        sent += len(chunk)
+    return sent
+
+def send_file_range(conn, f, offset, length, throttle=None):
+    """Send `length` bytes of `f` starting at `offset`, zero-copy when possible.
+
+    throttle(n), if given, is called before sending each n bytes.
+    """
+    sent = 0
+    if USE_SENDFILE:
+        try:
+            while sent < length:
+                count = length - sent
+                if throttle:
+                    count = min(count, SCHEDULER_QUANTUM)
+                    throttle(count)
+                end = sent + count
+                while sent < end:
+                    n = os.sendfile(conn.fileno(), f.fileno(), offset + sent, end - sent)
+                    if n == 0:  # end of file
+                        return sent
+                    sent += n
+            return sent
+        except OSError as e:
+            if e.errno not in SENDFILE_FALLBACK_ERRNOS:
+                raise
+            # sendfile is not usable for this file/socket, finish the range with reads
+    return sent + buffered_range(conn, f, offset + sent, length - sent, throttle)
+
+class FileRange:
+    """A byte range of a file, sent back as a response to a chunk request."""
+    def __init__(self, path, offset, length):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+class FileRanges:
+    """Several byte ranges of one file, sent back to back in request order."""
+    def __init__(self, path, ranges):
+        self.path = path
+        self.ranges = ranges
+
+def check_range(entry, offset, length):
+    """Return the length of a range clamped to the end of the file.
+
+    Raises ValueError for a negative offset or length, or an offset past the end.
+    """
+    if offset < 0 or length < 0:
+        raise ValueError("Negative offset or length")
+    if offset > entry.size:
+        raise ValueError(f"Offset {offset} past the end of the file ({entry.size} bytes)")
+    return min(length, entry.size - offset)
+
+def clamp_ranges(entry, ranges):
+    """Check (offset, length) pairs like check_range and merge contiguous ones.
+
+    Returns the clamped length of every range and the merged ranges to send.
+    """
+    lengths = []
+    merged = []
+    for offset, length in ranges:
+        length = check_range(entry, offset, length)
+        lengths.append(length)
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        elif length:
+            merged.append((offset, length))
+    return lengths, merged
+
+class Metrics:
+    """Counters and latency histograms of this server process."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.connections = 0
+        self.sessions = 0  # framed connections
+        self.bytes_sent = 0
+        self.sent_per_second = deque()  # [second, bytes] over the last RATE_WINDOW seconds
+        self.file_requests = Counter()
+        self.latency = {}  # command -> [count per bucket (last one is overflow), total ms]
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def session_opened(self):
+        with self.lock:
+            self.sessions += 1
+
+    def session_closed(self):
+        with self.lock:
+            self.sessions -= 1
+
+    def add_sent(self, n):
+        second = int(time.monotonic())
+        with self.lock:
+            self.bytes_sent += n
+            if self.sent_per_second and self.sent_per_second[-1][0] == second:
+                self.sent_per_second[-1][1] += n
+            else:
+                self.sent_per_second.append([second, n])
+                while self.sent_per_second[0][0] <= second - RATE_WINDOW:
+                    self.sent_per_second.popleft()
+
+    def count_file(self, filename):
+        with self.lock:
+            self.file_requests[filename] += 1
+
+    def observe(self, command, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            histogram = self.latency.setdefault(command, [[0] * (len(LATENCY_BUCKETS_MS) + 1), 0.0])
+            index = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), len(LATENCY_BUCKETS_MS))
+            histogram[0][index] += 1
+            histogram[1] += ms
+
+    def snapshot(self):
+        """Return the current metrics as a dict ready for JSON."""
+        second = int(time.monotonic())
+        with self.lock:
+            recent = sum(n for s, n in self.sent_per_second if s > second - RATE_WINDOW)
+            latency = {}
+            for command, (buckets, total_ms) in self.latency.items():
+                count = sum(buckets)
+                latency[command] = {
+                    "count": count,
+                    "avg_ms": round(total_ms / count, 3),
+                    "buckets_ms": dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ["inf"], buckets)),
+                }
+            return {
+                "time": time.time(),
+                "pid": os.getpid(),
+                "uptime": round(time.time() - self.started, 1),
+                "active_connections": self.connections,
+                "active_sessions": self.sessions,
+                "bytes_sent": self.bytes_sent,
+                "bytes_per_second": recent / RATE_WINDOW,
+                "file_requests": dict(self.file_requests.most_common()),
+                "latency": latency,
+            }
+
+    def dump(self, path, interval):
+        """Append a snapshot to `path` every `interval` seconds, meant for a daemon thread."""
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path, "a", encoding=FORMAT) as f:
+                    f.write(json.dumps(self.snapshot()) + "\n")
+            except OSError as e:
+                print(f"Error writing stats to {path}: {e}")
+
+metrics = Metrics()
+
+def merkle_root(hashes):
+    """Root of the binary SHA-256 tree over `hashes`; an odd last node moves up as is."""
+    if not hashes:
+        return hashlib.sha256(b"").digest()
+    level = list(hashes)
+    while len(level) > 1:
+        parents = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+def build_manifest(entry):
+    """Hash a file block by block and return its encoded manifest."""
+    hashes = []
+    f = catalog.acquire(entry.path)
+    try:
+        for offset in range(0, entry.size, MANIFEST_BLOCK):
+            hashes.append(hashlib.sha256(f.read_at(offset, MANIFEST_BLOCK)).digest())
+    finally:
+        catalog.release(f)
+    header = MANIFEST_HEADER.pack(entry.size, entry.mtime, MANIFEST_BLOCK, len(hashes))
+    return header + merkle_root(hashes) + b"".join(hashes)
+
+class ManifestCache:
+    """Encoded manifests of served files keyed by (inode, size, mtime), least recently used first.
+
+    A file that changed gets a new key; manifests beyond `limit` are dropped.
+    """
+    def __init__(self, limit=MAX_MANIFESTS):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.manifests = OrderedDict()  # (inode, size, mtime) -> manifest
+
+    def get(self, entry):
+        key = (entry.inode, entry.size, entry.mtime)
+        with self.lock:
+            manifest = self.manifests.get(key)
+            if manifest is not None:
+                self.manifests.move_to_end(key)
+                return manifest
+        manifest = build_manifest(entry)
+        with self.lock:
+            self.manifests[key] = manifest
+            while len(self.manifests) > self.limit:
+                self.manifests.popitem(last=False)
+        return manifest
+
+manifests = ManifestCache()
+
+def manifest_response(entry, request_id=None):
+    """Yield the manifest of a file, in a frame if `request_id` is given.
+
+    A generator, so the selectors engine hashes the file off the event loop.
+    """
+    manifest = manifests.get(entry)
+    if request_id is None:
+        yield manifest
+    else:
+        yield pack_frame(OP_MANIFEST, request_id, len(manifest)) + manifest
+
+class RequestDone:
+    """Marker queued after the responses of a request, to measure its latency."""
+    def __init__(self, command, start):
+        self.command = command
+        self.start = start
+
+    def record(self):
+        metrics.observe(self.command, time.perf_counter() - self.start)
+
+class Session:
+    """Per-connection state negotiated by a framed client."""
+    def __init__(self, addr):
+        self.addr = addr
+        self.codec = None
+
+def compress_block(codec, raw):
+    """Compress a block, or return None if that saves less than COMPRESS_MIN_SAVING."""
+    data = COMPRESSORS[codec](raw)
+    if len(data) > len(raw) * (1 - COMPRESS_MIN_SAVING):
+        return None
+    return data
+
+class BlockCache:
+    """LRU cache of compressed blocks, keyed by file, mtime, block index and codec."""
+    def __init__(self, max_bytes=COMPRESS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, entry, index, codec):
+        """Return the compressed block, or None if it doesn't compress."""
+        key = (entry.path, entry.mtime, entry.size, index, codec)
+        with self.lock:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                return self.blocks[key]
+        f = catalog.acquire(entry.path)
+        try:
+            raw = f.read_at(index * COMPRESS_BLOCK, COMPRESS_BLOCK)
+        finally:
+            catalog.release(f)
+        data = compress_block(codec, raw)  # None is cached too, so it isn't tried again
+        with self.lock:
+            if key not in self.blocks:
+                self.blocks[key] = data
+                self.size += self.cost(data)
+                while self.size > self.max_bytes:
+                    _, old = self.blocks.popitem(last=False)
+                    self.size -= self.cost(old)
+        return data
+
+    @staticmethod
+    def cost(data):
+        """Bytes a cached block counts toward the limit; blocks that don't compress are cached as None."""
+        return BLOCK_ENTRY_COST + (len(data) if data else 0)
+
+block_cache = BlockCache()
+
+def compressed_range(request_id, entry, offset, length, codec):
+    """Yield the frames answering a ZRANGE request, one per compression block.
+
+    Files whose first block doesn't compress are sent as they are, with sendfile.
+    """
+    end = min(offset + length, entry.size)
+    if offset >= end:
+        yield pack_frame(OP_ZRANGE, request_id, 0)
+        return
+    compressible = block_cache.get(entry, 0, codec) is not None
+    while offset < end:
+        index = offset // COMPRESS_BLOCK
+        block_end = min((index + 1) * COMPRESS_BLOCK, end)
+        raw_len = block_end - offset
+        flags = FLAG_MORE if block_end < end else 0
+        if not compressible:
+            data = None
+        elif offset == index * COMPRESS_BLOCK and block_end == min((index + 1) * COMPRESS_BLOCK, entry.size):
+            data = block_cache.get(entry, index, codec)  # whole block, cacheable
+        else:
+            # Range edges that split a block are compressed on the fly
+            f = catalog.acquire(entry.path)
+            try:
+                data = compress_block(codec, f.read_at(offset, raw_len))
+            finally:
+                catalog.release(f)
+        if data is None:
+            header = BLOCK_HEADER.pack(offset, raw_len, BLOCK_STORED)
+            yield pack_frame(OP_ZRANGE, request_id, len(header) + raw_len, flags) + header
+            yield FileRange(entry.path, offset, raw_len)
+        else:
+            header = BLOCK_HEADER.pack(offset, raw_len, BLOCK_COMPRESSED)
+            yield pack_frame(OP_ZRANGE, request_id, len(header) + len(data), flags) + header + data
+        offset = block_end
+
+def is_ranges_request(parts):
+    """True for "RANGES filename offset:length ...".
+
+    A range request of a file named RANGES has no colons, so it is still served as one.
+    """
+    return len(parts) >= 3 and parts[0] == "RANGES" and all(":" in part for part in parts[2:])
+
+def is_stats_request(parts):
+    """True for "STATS", unless a served file has that name: its size is asked for then."""
+    return parts == ["STATS"] and catalog.get("STATS") is None
+
+def request_command(parts):
+    """Name of a text request, as reported in the latency metrics."""
+    if is_stats_request(parts):
+        return "stats"
+    if is_ranges_request(parts):
+        return "ranges"
+    if len(parts) == 2 and parts[0] == "MANIFEST":
+        return "manifest"
+    if len(parts) == 2 and parts[0] == "STAT":
+        return "stat"
+    return {1: "size", 3: "range"}.get(len(parts), "invalid")
+
+def handle_request(data, addr):
+    """Process one client request. Returns a list of responses (bytes or FileRange)."""
+    start = time.perf_counter()
+    parts = data.split()
+    return run_request(parts, addr) + [RequestDone(request_command(parts), start)]
+
+def run_request(parts, addr):
+    if is_stats_request(parts):
+        return [json.dumps(metrics.snapshot()).encode(FORMAT)]
+
+    elif is_ranges_request(parts): # RANGES filename offset:length ...
+        filename = parts[1]
+        metrics.count_file(filename)
+        try:
+            ranges = [tuple(int(x) for x in part.split(":")) for part in parts[2:]]
+            entry = catalog.get(filename)
+
+            if entry is not None:
+                # Ranges past the end of the file are truncated, like single range requests,
+                # so the data starts with the clamped length of every range
+                lengths, body = clamp_ranges(entry, ranges)
+                table = b"".join(RANGE_LENGTH.pack(length) for length in lengths)
+                return [table, FileRanges(entry.path, body)]
+            return [f"Error: Cannot found: {filename}".encode(FORMAT)]
+        except Exception as e:
+            return [f"Error: {str(e)}".encode(FORMAT)]
+
+    elif len(parts) == 2 and parts[0] == "MANIFEST": # MANIFEST filename
+        filename = parts[1]
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is not None:
+            return [manifest_response(entry)]
+        return [f"Error: Cannot found: {filename}".encode(FORMAT)]
+
+    elif len(parts) == 2 and parts[0] == "STAT": # STAT filename
+        filename = parts[1]
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is not None:
+            return [f"{entry.size} {entry.mtime!r}".encode(FORMAT)]
+        return [f"Error: Cannot found: {filename}".encode(FORMAT)]
+
+    elif len(parts) == 1: # Request for file size
+        filename = parts[0]
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is not None:
+            print(f"Server: sent file size for {filename} to {addr}")
+            return [str(entry.size).encode(FORMAT)]
+        return [f"Error: Cannot found: {filename}".encode(FORMAT)]
+
+    elif len(parts) == 3: # Request for file chunk
+        filename, offset_str, len_str = parts
+        metrics.count_file(filename)
+        try:
+            offset = int(offset_str)
+            length = int(len_str)
+            entry = catalog.get(filename)
+
+            if entry is not None:
+                return [FileRange(entry.path, offset, check_range(entry, offset, length))]
+            return [f"Error: Cannot found: {filename}".encode(FORMAT)]
+        except Exception as e:
+            return [f"Error: {str(e)}".encode(FORMAT)]
+
+    return ["Error: Command doesn't work".encode(FORMAT)]
+
+def pack_frame(opcode, request_id, length, flags=0):
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, opcode, flags, request_id, length)
+
+def error_frame(request_id, message):
+    payload = message.encode(FORMAT)
+    return pack_frame(OP_ERROR, request_id, len(payload)) + payload
+
+def handle_frame(opcode, request_id, payload, session):
+    """Process one framed request.
+
+    Returns a list of responses: bytes, FileRange, FileRanges or a generator of those.
+    """
+    start = time.perf_counter()
+    responses = run_frame(opcode, request_id, payload, session)
+    return responses + [RequestDone(FRAME_COMMANDS.get(opcode, "invalid"), start)]
+
+def run_frame(opcode, request_id, payload, session):
+    addr = session.addr
+    if opcode == OP_HELLO:
+        offered = payload.decode(FORMAT).split(",") if payload else []
+        session.codec = next((codec for codec in COMPRESSION_CODECS if codec in offered), None)
+        if session.codec is None:
+            return [pack_frame(OP_HELLO, request_id, 0)]
+        response = HELLO_RESPONSE.pack(COMPRESS_BLOCK) + session.codec.encode(FORMAT)
+        return [pack_frame(OP_HELLO, request_id, len(response)) + response]
+
+    elif opcode == OP_LIST:
+        return [pack_frame(OP_LIST, request_id, len(catalog.listing)) + catalog.listing]
+
+    elif opcode == OP_SIZE:
+        filename = payload.decode(FORMAT)
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is None:
+            return [error_frame(request_id, f"Error: Cannot found: {filename}")]
+        print(f"Server: sent file size for {filename} to {addr}")
+        return [pack_frame(OP_SIZE, request_id, SIZE_RESPONSE.size) + SIZE_RESPONSE.pack(entry.size)]
+
+    elif opcode == OP_STAT:
+        filename = payload.decode(FORMAT)
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is None:
+            return [error_frame(request_id, f"Error: Cannot found: {filename}")]
+        return [pack_frame(OP_STAT, request_id, STAT_RESPONSE.size) + STAT_RESPONSE.pack(entry.size, entry.mtime)]
+
+    elif opcode == OP_RANGE:
+        offset, length = RANGE_REQUEST.unpack_from(payload)
+        filename = payload[RANGE_REQUEST.size:].decode(FORMAT)
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is None:
+            return [error_frame(request_id, f"Error: Cannot found: {filename}")]
+        # The header carries the exact length, so clamp the range to the end of the file
+        length = max(0, min(length, entry.size - offset))
+        return [pack_frame(OP_RANGE, request_id, length), FileRange(entry.path, offset, length)]
+
+    elif opcode == OP_RANGES:
+        name_len, = RANGES_HEADER.unpack_from(payload)
+        start = RANGES_HEADER.size + name_len
+        filename = payload[RANGES_HEADER.size:start].decode(FORMAT)
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is None:
+            return [error_frame(request_id, f"Error: Cannot found: {filename}")]
+        ranges = list(RANGE_REQUEST.iter_unpack(payload[start:]))
+        try:
+            lengths, body = clamp_ranges(entry, ranges)
+        except ValueError as e:
+            return [error_frame(request_id, f"Error: {e}")]
+        # The response starts with the clamped length of every requested range
+        table = b"".join(RANGE_LENGTH.pack(length) for length in lengths)
+        return [pack_frame(OP_RANGES, request_id, len(table) + sum(lengths)) + table,
+                FileRanges(entry.path, body)]
+
+    elif opcode == OP_ZRANGE:
+        offset, length = RANGE_REQUEST.unpack_from(payload)
+        filename = payload[RANGE_REQUEST.size:].decode(FORMAT)
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is None:
+            return [error_frame(request_id, f"Error: Cannot found: {filename}")]
+        if session.codec is None:
+            return [error_frame(request_id, "Error: No compression negotiated")]
+        return [compressed_range(request_id, entry, offset, length, session.codec)]
+
+    elif opcode == OP_MANIFEST:
+        filename = payload.decode(FORMAT)
+        metrics.count_file(filename)
+        entry = catalog.get(filename)
+        if entry is None:
+            return [error_frame(request_id, f"Error: Cannot found: {filename}")]
+        return [manifest_response(entry, request_id)]
+
+    elif opcode == OP_STATS:
+        stats = json.dumps(metrics.snapshot()).encode(FORMAT)
+        return [pack_frame(OP_STATS, request_id, len(stats)) + stats]
+
+    return [error_frame(request_id, "Error: Command doesn't work")]
+
+def parse_frames(buffer):
+    """Split complete request frames off the front of `buffer`.
+
+    Returns the list of (opcode, request id, payload) and the unparsed rest.
+    """
+    frames = []
+    while len(buffer) >= FRAME_HEADER.size:
+        magic, version, opcode, _, request_id, length = FRAME_HEADER.unpack_from(buffer)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION:
+            raise ValueError("Invalid frame header")
+        if length > MAX_REQUEST_PAYLOAD:
+            raise ValueError(f"Request frame too large: {length} bytes")
+        end = FRAME_HEADER.size + length
+        if len(buffer) < end:
+            break
+        frames.append((opcode, request_id, buffer[FRAME_HEADER.size:end]))
+        buffer = buffer[end:]
+    return frames, buffer
+
+def send_ranges_buffered(conn, f, ranges, throttle=None):
+    """Send several ranges with positional reads, gathering up to `unit` bytes per send.
+
+    Returns the number of bytes sent.
+    """
+    sent = 0
+    batch = []
+    batch_size = 0
+    for offset, length in ranges:
+        done = 0
+        while done < length:
+            chunk = f.read_at(offset + done, min(unit, length - done))
+            if not chunk:
+                break
+            batch.append(chunk)
+            batch_size += len(chunk)
+            done += len(chunk)
+            if batch_size >= unit:
+                if throttle:
+                    throttle(batch_size)
+                sendall_vectored(conn, batch)
+                sent += batch_size
+                batch = []
+                batch_size = 0
+    if batch:
+        if throttle:
+            throttle(batch_size)
+        sendall_vectored(conn, batch)
+        sent += batch_size
+    return sent
+
+def sendall_vectored(conn, buffers):
+    """Send a list of buffers with as few syscalls as possible."""
+    if not hasattr(conn, "sendmsg"):
+        conn.sendall(b"".join(buffers))
+        return
+    views = [memoryview(b) for b in buffers]
+    while views:
+        n = conn.sendmsg(views)
+        while views and n >= len(views[0]):
+            n -= len(views[0])
+            views.pop(0)
+        if views and n:
+            views[0] = views[0][n:]
+
+def send_response(conn, response, throttle=None):
+    """Send one response from handle_request on a blocking socket."""
+    if isinstance(response, (FileRange, FileRanges)):
+        f = catalog.acquire(response.path)
+        try:
+            if isinstance(response, FileRange):
+                sent = send_file_range(conn, f, response.offset, response.length, throttle)
+            elif USE_SENDFILE:
+                sent = sum(send_file_range(conn, f, offset, length, throttle)
+                           for offset, length in response.ranges)
+            else:
+                sent = send_ranges_buffered(conn, f, response.ranges, throttle)
+        finally:
+            catalog.release(f)
+        metrics.add_sent(sent)
+    elif isinstance(response, (bytes, bytearray)):
+        if throttle:
+            throttle(len(response))
+        conn.sendall(response)
+        metrics.add_sent(len(response))
+    elif isinstance(response, RequestDone):
+        response.record()
+    else:
+        for item in response:
+            send_response(conn, item, throttle)
+
+def client_throttle(addr):
+    """Return the throttle function of a client, or None without bandwidth limits."""
+    if not scheduler.enabled:
+        return None
+    return lambda size: scheduler.acquire(addr[0], size)
+
 def process_client(conn, addr):
     print(f"***Welcome***{addr} CONNECTED***")
+    metrics.connection_opened()
     try:
-        file_list = read_file_list(os.path.join(FILE_LIST_PATH, "file_list.txt"))
-        conn.send(file_list.encode(FORMAT))
+        conn.sendall(catalog.listing)
+        metrics.add_sent(len(catalog.listing))
         
         while True:
-            data = conn.recv(1024).decode(FORMAT)
+            data = conn.recv(1024)
             if not data:
                 break
+            if data.startswith(FRAME_MAGIC):
+                process_framed_client(conn, addr, data)
+                break
 
-            parts = data.split()
-            if len(parts) == 1: # Request for file size
-                filename = parts[0]
-                file_path = os.path.join(FILE_FOLDER_PATH, filename)
-                if os.path.exists(file_path):
-                    file_size = os.path.getsize(file_path)
-                    conn.send(str(file_size).encode(FORMAT))
-                    print(f"Server: sent file size for {filename} to {addr}")
-                else:
-                    conn.send(f"Error: Cannot found: {filename}".encode(FORMAT))
-            
-            elif len(parts) == 3: # Request for file chunk
-                filename, offset_str, len_str = parts
-                try:
-                    offset = int(offset_str)
-                    length = int(len_str)
-                    file_path = os.path.join(FILE_FOLDER_PATH, filename)
-
-                    if os.path.exists(file_path):
-                        with open(file_path, 'rb') as f:
-                            f.seek(offset)
-                            remaining = length
-                            while remaining > 0:
-                                chunk_size = min(unit, remaining)
-                                chunk = f.read(chunk_size)
-                                if not chunk:
-                                    break
-
-                                conn.send(chunk)
-                                remaining -= len(chunk)
-                    else:
-                        conn.send(f"Error: Cannot found: {filename}".encode(FORMAT))
-                except Exception as e:
-                    conn.send(f"Error: {str(e)}".encode(FORMAT))
-
-            else:
-                conn.send("Error: Command doesn't work".encode(FORMAT))
+            for response in handle_request(data.decode(FORMAT), addr):
+                send_response(conn, response, client_throttle(addr))
     except Exception as e:
         print(f"Error processing request of client {addr}: {e}")
     finally:
         conn.close()
+        metrics.connection_closed()
         print(f"***Goodbye***{addr} disconnected***")
 
+def process_framed_client(conn, addr, buffer):
+    """Serve pipelined framed requests until the client disconnects."""
+    session = Session(addr)
+    throttle = client_throttle(addr)
+    metrics.session_opened()
+    try:
+        while True:
+            frames, buffer = parse_frames(buffer)
+            for opcode, request_id, payload in frames:
+                for response in handle_frame(opcode, request_id, payload, session):
+                    send_response(conn, response, throttle)
+            data = conn.recv(64 * 1024)
+            if not data:
+                break
+            buffer += data
+    finally:
+        metrics.session_closed()
+
+class EventClient:
+    """State of one client connection in the selectors engine.
+
+    `offload(client, generator)` produces the next response of a generator on
+    another thread and returns its future, so compressing or hashing never
+    holds up the event loop.
+    """
+    def __init__(self, conn, addr, offload):
+        self.conn = conn
+        self.addr = addr
+        self.offload = offload
+        self.responses = deque()  # responses waiting to be sent
+        self.pending = None  # (generator, future of its next response) being produced
+        self.framed = False
+        self.session = Session(addr)
+        self.inbuf = b""  # framed mode: bytes of requests not parsed yet
+        self.buffer = b""  # bytes of the current response not sent yet
+        self.file = None  # file of the FileRange being sent
+        self.offset = 0
+        self.remaining = 0
+        self.use_sendfile = USE_SENDFILE
+        self.allowance = 0  # bytes granted by the bandwidth scheduler, not sent yet
+        self.bw_request = None
+        self.throttled = False  # waiting for the bandwidth scheduler
+
+    def has_output(self):
+        return bool(self.buffer or self.file or self.responses or self.pending)
+
+    def wants_read(self):
+        # Framed clients may pipeline requests, up to MAX_PIPELINE queued responses
+        if self.framed:
+            return len(self.responses) < MAX_PIPELINE
+        return not self.has_output()
+
+    def handle_data(self, data):
+        """Queue the responses for the requests received in `data`."""
+        if not self.framed and data.startswith(FRAME_MAGIC):
+            self.framed = True
+            metrics.session_opened()
+        if not self.framed:
+            self.responses.extend(handle_request(data.decode(FORMAT), self.addr))
+            return
+        frames, self.inbuf = parse_frames(self.inbuf + data)
+        for opcode, request_id, payload in frames:
+            self.responses.extend(handle_frame(opcode, request_id, payload, self.session))
+
+    def start_next_response(self):
+        response = self.responses.popleft()
+        if isinstance(response, FileRanges):
+            # Send the ranges one after the other, each one as a FileRange
+            for offset, length in reversed(response.ranges):
+                self.responses.appendleft(FileRange(response.path, offset, length))
+        elif isinstance(response, FileRange):
+            self.file = catalog.acquire(response.path)
+            self.offset = response.offset
+            self.remaining = response.length
+        elif isinstance(response, (bytes, bytearray)):
+            self.buffer = memoryview(response)
+        elif isinstance(response, RequestDone):
+            response.record()
+        else:
+            # Generator of responses: produce the next one only when it can be sent
+            self.pending = (response, self.offload(self, response))
+
+    def resume_pending(self):
+        """Queue the response produced off the loop. Returns False if it isn't ready yet."""
+        generator, future = self.pending
+        if not future.done():
+            return False
+        self.pending = None
+        item = future.result()
+        if item is not None:
+            self.responses.appendleft(generator)
+            self.responses.appendleft(item)
+        return True
+
+    def close_file(self):
+        if self.file:
+            catalog.release(self.file)
+            self.file = None
+
+    def take_allowance(self):
+        """Make sure some bandwidth is granted. Returns False if the client must wait."""
+        if not scheduler.enabled or self.allowance > 0:
+            return True
+        with scheduler.cond:
+            if self.bw_request is None:
+                self.bw_request = scheduler.submit(self.addr[0], scheduler.quantum)
+            scheduler.schedule()
+            if not self.bw_request.granted:
+                return False
+            self.allowance = self.bw_request.size
+            self.bw_request = None
+        return True
+
+    def spend(self, n):
+        if scheduler.enabled:
+            self.allowance -= n
+
+    def write(self):
+        """Send as much pending output as the socket and the bandwidth scheduler allow."""
+        self.throttled = False
+        while self.has_output():
+            if self.pending:
+                if not self.resume_pending():
+                    return  # served again once it is ready
+                continue
+            if (self.buffer or self.file) and not self.take_allowance():
+                self.throttled = True
+                return
+            if self.buffer:
+                limit = self.allowance if scheduler.enabled else len(self.buffer)
+                n = self.conn.send(self.buffer[:limit])
+                self.buffer = self.buffer[n:]
+                self.spend(n)
+                metrics.add_sent(n)
+            elif self.file:
+                if self.remaining <= 0:
+                    self.close_file()
+                    continue
+                progress = self.send_file_block()
+                if progress is None:
+                    return  # socket is full, wait for the next EVENT_WRITE
+                if not progress:
+                    self.close_file()
+            else:
+                self.start_next_response()
+
+    def send_file_block(self):
+        """Send part of the current file range.
+
+        Returns True on progress, False at end of file and None if the socket is full.
+        """
+        if self.use_sendfile:
+            count = min(self.remaining, self.allowance) if scheduler.enabled else self.remaining
+            try:
+                n = os.sendfile(self.conn.fileno(), self.file.fileno(), self.offset, count)
+                self.spend(n)
+                metrics.add_sent(n)
+            except BlockingIOError:
+                return None
+            except OSError as e:
+                if e.errno not in SENDFILE_FALLBACK_ERRNOS:
+                    raise
+                self.use_sendfile = False
+                return True
+        else:
+            # Buffer at most STREAM_BLOCK bytes, the rest stays on disk until the socket drains
+            block = self.file.read_at(self.offset, min(STREAM_BLOCK, self.remaining))
+            if not block:
+                return False
+            self.buffer = memoryview(block)
+            n = len(block)
+        if n == 0:
+            return False
+        self.offset += n
+        self.remaining -= n
+        return True
+
+    def close(self):
+        self.close_file()
+        if self.bw_request is not None:
+            with scheduler.cond:
+                scheduler.cancel(self.bw_request)
+        self.conn.close()
+        metrics.connection_closed()
+        if self.framed:
+            metrics.session_closed()
+        print(f"***Goodbye***{self.addr} disconnected***")
+
+def start_event_server():
+    """Serve all clients from one thread with a selectors event loop."""
+    print("Server is ready...")
+    server.listen()
+    print(f"Waiting at IP: {HOST} - Port: {PORT} (selectors mode, max {MAX_CONNECTIONS} clients)")
+
+    selector = selectors.DefaultSelector()
+    server.setblocking(False)
+    selector.register(server, selectors.EVENT_READ)
+    clients = {}
+    accepting = True
+
+    # Responses produced by the offload threads wake the loop through a socket pair
+    executor = ThreadPoolExecutor(OFFLOAD_THREADS)
+    wakeup, waker = socket.socketpair()
+    wakeup.setblocking(False)
+    waker.setblocking(False)
+    selector.register(wakeup, selectors.EVENT_READ)
+    ready = deque()  # clients whose offloaded response is done
+
+    def offload(client, generator):
+        future = executor.submit(next, generator, None)
+
+        def done(_):
+            ready.append(client)
+            try:
+                waker.send(b"\0")
+            except BlockingIOError:
+                pass  # the loop has wakeups to read already
+        future.add_done_callback(done)
+        return future
+
+    def close_client(client):
+        nonlocal accepting
+        selector.unregister(client.conn)
+        del clients[client.conn]
+        client.close()
+        if not accepting and len(clients) < MAX_CONNECTIONS:
+            selector.register(server, selectors.EVENT_READ)
+            accepting = True
+
+    def update_interest(client):
+        # Backpressure: stop reading requests while too many responses are waiting
+        events = 0
+        if client.has_output() and not client.throttled and not client.pending:
+            events |= selectors.EVENT_WRITE
+        if client.wants_read():
+            events |= selectors.EVENT_READ
+        # A throttled client is retried every SCHEDULER_TICK, watch it for disconnects meanwhile
+        selector.modify(client.conn, events or selectors.EVENT_READ)
+
+    def serve(client, readable):
+        try:
+            if readable:
+                data = client.conn.recv(64 * 1024 if client.framed else 1024)
+                if not data:
+                    close_client(client)
+                    return
+                client.handle_data(data)
+            if client.has_output():
+                client.write()
+            update_interest(client)
+        except (BlockingIOError, InterruptedError):
+            update_interest(client)
+        except Exception as e:
+            print(f"Error processing request of client {client.addr}: {e}")
+            close_client(client)
+
+    try:
+        while True:
+            throttled = [client for client in clients.values() if client.throttled]
+            for client in throttled:
+                serve(client, False)
+            timeout = SCHEDULER_TICK if throttled else 1.0
+            for key, events in selector.select(timeout=timeout):
+                if key.fileobj is wakeup:
+                    try:
+                        while wakeup.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    while ready:
+                        client = ready.popleft()
+                        if clients.get(client.conn) is client:
+                            serve(client, False)
+                    continue
+                if key.fileobj is server:
+                    try:
+                        conn, addr = server.accept()
+                    except BlockingIOError:
+                        continue
+                    print(f"***Welcome***{addr} CONNECTED***")
+                    metrics.connection_opened()
+                    conn.setblocking(False)
+                    client = EventClient(conn, addr, offload)
+                    clients[conn] = client
+                    client.responses.append(catalog.listing)
+                    selector.register(conn, selectors.EVENT_WRITE)
+                    if len(clients) >= MAX_CONNECTIONS:
+                        selector.unregister(server)
+                        accepting = False
+                    continue
+
+                client = clients.get(key.fileobj)
+                if client is not None:
+                    serve(client, events & selectors.EVENT_READ)
+    except KeyboardInterrupt:
+        print("\nServer is shutting down...")
+    finally:
+        for client in list(clients.values()):
+            client.close()
+        executor.shutdown(wait=False)
+        selector.close()
+        wakeup.close()
+        waker.close()
+        server.close()
+
 def start_server():
     print("Server is ready...")
     server.listen()
@@ -97,5 +1360,113 @@ def start_server():
 
     server.close()
 
+def start_background_threads():
+    """Start the catalog refresh and the periodic stats dump of this process."""
+    threading.Thread(target=catalog.watch, daemon=True).start()
+    if STATS_FILE:
+        threading.Thread(target=metrics.dump, args=(STATS_FILE, STATS_INTERVAL), daemon=True).start()
+
+def run_worker(mode, listener):
+    """Body of a worker process: serve clients until interrupted."""
+    global server
+    # Only the supervisor handles Ctrl+C, it stops workers with SIGTERM.
+    # Workers shut down on SIGTERM like on Ctrl+C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server = listener if listener is not None else create_server_socket(reuse_port=True)
+    start_background_threads()
+    if mode == "selectors":
+        start_event_server()
+    else:
+        start_server()
+
+def start_worker_pool(mode, count):
+    """Fork `count` worker processes and restart any worker that dies."""
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    listener = None
+    if not reuse_port:
+        listener = create_server_socket()
+        listener.listen()
+
+    workers = {}  # pid -> (worker number, start time)
+
+    def spawn(number):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(mode, listener)
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                print(f"Worker {number} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = (number, time.monotonic())
+        print(f"Started worker {number} (pid {pid})")
+
+    for number in range(count):
+        spawn(number)
+    try:
+        while workers:
+            pid, status = os.wait()
+            number, started = workers.pop(pid, (None, 0))
+            if number is None:
+                continue
+            print(f"Worker {number} (pid {pid}) exited with status {status}, restarting...")
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)
+            spawn(number)
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        print("\nServer is shutting down, stopping workers...")
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(workers):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    finally:
+        if listener is not None:
+            listener.close()
+
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="TCP file server")
+    parser.add_argument("--mode", choices=["threaded", "selectors"], default=SERVER_MODE,
+                        help="server engine (default: %(default)s)")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="selectors mode: max simultaneous clients (default: %(default)s)")
+    parser.add_argument("--max-rate", type=int, default=GLOBAL_RATE,
+                        help="total bandwidth in bytes/s, 0 for unlimited (default: %(default)s)")
+    parser.add_argument("--client-rate", type=int, default=CLIENT_RATE,
+                        help="bandwidth per client IP in bytes/s, 0 for unlimited (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--stats-file", default=STATS_FILE,
+                        help="append metrics as JSON lines to this file")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="seconds between two lines of --stats-file (default: %(default)s)")
+    args = parser.parse_args()
+    MAX_CONNECTIONS = args.max_connections
+    STATS_FILE = args.stats_file
+    STATS_INTERVAL = args.stats_interval
+    scheduler = BandwidthScheduler(args.max_rate, args.client_rate)
+
+    if args.workers > 1 and hasattr(os, "fork"):
+        if args.max_rate or args.client_rate:
+            print("Note: bandwidth limits apply to each worker separately")
+        start_worker_pool(args.mode, args.workers)
+    else:
+        if args.workers > 1:
+            print("Multiple workers need os.fork, running a single process")
+        server = create_server_socket()
+        start_background_threads()
+        if args.mode == "selectors":
+            start_event_server()
+        else:
+            start_server()
\ No newline at end of file
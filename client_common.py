@@ -0,0 +1,384 @@
+"""Helpers shared by Client-TCP.py and Client - UDP.py.
+
+Both clients write downloads in place, keep a range journal to resume them,
+verify them against a Merkle manifest, share a bandwidth budget, report
+progress and watch input.txt the same way; only the transfer itself differs.
+Keep this file next to the two client scripts.
+"""
+import os
+import sys
+import time
+import json
+import struct
+import socket
+import select
+import hashlib
+import threading
+import ctypes
+import ctypes.util
+
+
+FORMAT = "utf-8"
+
+# Resumable downloads: a journal next to each unfinished download records the
+# byte ranges already on disk, with the size and mtime of the file on the server
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_SYNC_INTERVAL = 1.0  # seconds between fsyncs of the download and its journal
+
+# Progress: a reporter thread samples the download counters every PROGRESS_INTERVAL
+# seconds and shows a status line ("terminal"), writes JSON lines ("json") or nothing ("none")
+PROGRESS_FORMAT = "terminal"
+PROGRESS_INTERVAL = 0.5
+PROGRESS_FILE = None  # JSON lines are appended here instead of stdout if set
+RATE_SMOOTHING = 0.3  # weight of the newest sample in the current rate
+
+# input.txt is watched with inotify where available, otherwise polled. Lines are
+# read from where the last read stopped
+INPUT_POLL_INTERVAL = 0.5  # seconds between stat() calls without inotify
+INPUT_SETTLE_TIME = 2.0  # a last line without newline is taken once the file is unchanged this long
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+
+def preallocate(path, size):
+    """Create `path` with `size` bytes reserved and return a descriptor for positional writes."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not available on this platform or filesystem, a sparse file will do
+        os.ftruncate(fd, size)
+    return fd
+
+
+write_lock = threading.Lock()  # only used where os.pwrite is missing
+
+
+def write_at(fd, data, offset):
+    """Write `data` at `offset` in the file open as `fd`, from any thread."""
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, data, offset)
+    with write_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+
+def merkle_root(hashes):
+    if not hashes:
+        return hashlib.sha256(b"").digest()
+    level = list(hashes)
+    while len(level) > 1:
+        parents = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def merge_ranges(ranges):
+    """Sort (start, end) ranges and join the ones that overlap or touch."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def missing_ranges(done, size):
+    """The (start, end) ranges of [0, size) not covered by the merged ranges `done`."""
+    missing = []
+    position = 0
+    for start, end in done:
+        if start > position:
+            missing.append((position, start))
+        position = max(position, end)
+    if position < size:
+        missing.append((position, size))
+    return missing
+
+
+class RangeJournal:
+    """Sidecar file recording the byte ranges of a download that are safely on disk.
+
+    The first line holds the size and mtime of the file on the server, each
+    following line "offset length" of a downloaded range. Ranges are batched
+    and only written after the download itself was fsynced, so after a crash
+    the journal never claims data that was lost. `done` are the ranges loaded
+    from an existing journal, which is then appended to.
+    """
+    def __init__(self, path, data_fd, size, mtime, done=None):
+        self.path = path
+        self.data_fd = data_fd
+        self.size = size
+        self.lock = threading.Lock()
+        self.done = list(done or [])
+        self.pending = []
+        self.last_sync = time.monotonic()
+        if done is not None:
+            self.file = open(path, "a")
+        else:
+            self.file = open(path, "w")
+            self.file.write(f"{size} {mtime!r}\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    @staticmethod
+    def load(path, size, mtime):
+        """Ranges recorded in the journal at `path`, None if there is none or it is for another version of the file."""
+        try:
+            with open(path) as f:
+                lines = f.read().split("\n")
+            header = lines[0].split()
+            if int(header[0]) != size or float(header[1]) != mtime:
+                return None
+        except (OSError, IndexError, ValueError):
+            return None
+        ranges = []
+        for line in lines[1:-1]:  # the last line is empty, or was cut short by a crash
+            try:
+                offset, length = map(int, line.split())
+            except ValueError:
+                continue
+            ranges.append((offset, offset + length))
+        return merge_ranges(ranges)
+
+    def record(self, offset, length):
+        with self.lock:
+            self.pending.append((offset, offset + length))
+            if time.monotonic() - self.last_sync >= JOURNAL_SYNC_INTERVAL:
+                self.sync()
+
+    def sync(self):
+        self.last_sync = time.monotonic()
+        if not self.pending:
+            return
+        getattr(os, "fdatasync", os.fsync)(self.data_fd)
+        pending = merge_ranges(self.pending)
+        self.file.write("".join(f"{start} {end - start}\n" for start, end in pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done = merge_ranges(self.done + pending)
+        self.pending = []
+
+    def complete(self):
+        with self.lock:
+            return not missing_ranges(merge_ranges(self.done + self.pending), self.size)
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
+
+    def remove(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class TokenBucket:
+    """Limits the bytes requested per second, over all download threads."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """Wait until `size` more bytes may be requested."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # Going into debt makes the following requests wait their turn
+            self.tokens -= size
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ProgressReporter:
+    """Samples the running downloads at a fixed rate and reports their progress.
+
+    The download threads never print or take a lock for this; they only bump
+    their own counters, which are read here.
+    """
+    def __init__(self, downloads, fmt=PROGRESS_FORMAT, interval=PROGRESS_INTERVAL, path=PROGRESS_FILE):
+        self.downloads = downloads  # returns the running FileDownloads
+        self.fmt = fmt
+        self.interval = interval
+        self.path = path
+        self.samples = {}  # FileDownload -> (time, bytes done, rate)
+        self.width = 0
+
+    def run(self, stop_event):
+        if self.fmt == "none":
+            return
+        out = open(self.path, "a") if self.path else sys.stdout
+        try:
+            while not stop_event.wait(self.interval):
+                self.report(out)
+        finally:
+            if self.path:
+                out.close()
+
+    def sample(self, download, now):
+        done = download.done()
+        previous = self.samples.get(download)
+        rate = 0.0
+        if previous:
+            last_time, last_done, last_rate = previous
+            current = (done - last_done) / max(now - last_time, 1e-6)
+            rate = current if not last_rate else RATE_SMOOTHING * current + (1 - RATE_SMOOTHING) * last_rate
+        self.samples[download] = (now, done, rate)
+        elapsed = now - (download.started or now)
+        average = (done - download.skipped) / elapsed if elapsed > 0 else 0.0
+        speed = rate or average
+        return {"time": round(time.time(), 3), "file": download.filename, "bytes": done, "size": download.size,
+                "rate": round(rate), "average_rate": round(average),
+                "eta": round((download.size - done) / speed, 1) if speed else None}
+
+    def report(self, out):
+        now = time.monotonic()
+        running = self.downloads()
+        stats = [self.sample(download, now) for download in running]
+        for download in [d for d in self.samples if d not in running]:
+            # Finished since the last sample
+            stat = self.sample(download, now)
+            stat["finished"] = True
+            stats.append(stat)
+            del self.samples[download]
+
+        if self.fmt == "json":
+            for stat in stats:
+                out.write(json.dumps(stat) + "\n")
+            out.flush()
+        elif stats:
+            line = " | ".join(
+                f"{st['file']}: {int(st['bytes'] / st['size'] * 100)}% {st['rate'] / (1024 * 1024):.1f} MB/s"
+                + (f" ETA {st['eta']:.0f}s" if st["eta"] is not None and not st.get("finished") else "")
+                for st in stats)
+            line += f" | total {sum(st['rate'] for st in stats) / (1024 * 1024):.1f} MB/s"
+            out.write("\r" + line.ljust(self.width))
+            out.flush()
+            self.width = len(line)
+
+
+class InputFileReader:
+    """Reads the lines added to a file since the previous read."""
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.offset = 0  # end of the last complete line read
+        self.size = None  # size at the previous read
+        self.changed_at = 0.0  # when the size last changed
+        self.partial = False  # a last line without newline is waiting
+
+    def read_new_lines(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.inode = None
+            return []
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # Replaced or truncated, read it again from the start
+            self.inode = st.st_ino
+            self.offset = 0
+            self.size = None
+        now = time.monotonic()
+        if st.st_size != self.size:
+            self.size = st.st_size
+            self.changed_at = now
+        quiet = now - self.changed_at >= INPUT_SETTLE_TIME
+        if st.st_size == self.offset:
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(st.st_size - self.offset)
+        complete = data.rfind(b"\n") + 1
+        self.offset += complete
+        # A last line without newline may still be being written; it is only
+        # taken once the file stopped growing, and read again if it grows
+        self.partial = complete < len(data) and not quiet
+        if not quiet:
+            data = data[:complete]
+        return [line.strip() for line in data.decode(FORMAT, "replace").splitlines() if line.strip()]
+
+
+def inotify_watch(directory):
+    """An inotify descriptor watching `directory`, or None where inotify is not available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def inotify_names(data):
+    """Names of the files in a buffer of inotify events."""
+    names = []
+    position = 0
+    while position < len(data):
+        _, _, _, length = INOTIFY_EVENT.unpack_from(data, position)
+        position += INOTIFY_EVENT.size
+        names.append(data[position:position + length].rstrip(b"\0").decode(FORMAT, "replace"))
+        position += length
+    return names
+
+
+def follow_input_file(path, on_lines):
+    """Call on_lines() with the lines added to the file at `path`, as soon as they are added."""
+    reader = InputFileReader(path)
+    fd = inotify_watch(os.path.dirname(os.path.abspath(path)))
+    while True:
+        on_lines(reader.read_new_lines())
+        if fd is None:
+            time.sleep(INPUT_POLL_INTERVAL)
+            continue
+        while True:
+            # With a partial last line, look again once the file was quiet for a while
+            if not select.select([fd], [], [], INPUT_SETTLE_TIME if reader.partial else None)[0]:
+                break
+            try:
+                if os.path.basename(path) in inotify_names(os.read(fd, 64 * 1024)):
+                    break
+            except BlockingIOError:
+                pass
+
+
+def serve_control_socket(path, queue_files):
+    """Accept download requests, one file name per line, on the unix socket at `path`.
+
+    queue_files(names) queues the names and returns the ones not requested before.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return
+    if os.path.exists(path):
+        os.remove(path)
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    control.bind(path)
+    control.listen()
+    while True:
+        conn, _ = control.accept()
+        threading.Thread(target=handle_control_client, args=(conn, queue_files), daemon=True).start()
+
+
+def handle_control_client(conn, queue_files):
+    with conn, conn.makefile("r", encoding=FORMAT) as lines:
+        for line in lines:
+            filename = line.strip()
+            if filename:
+                reply = f"queued {filename}\n" if queue_files([filename]) else f"already requested {filename}\n"
+                conn.sendall(reply.encode(FORMAT))
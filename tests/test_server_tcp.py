@@ -0,0 +1,249 @@
+import importlib.util
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_PATH = os.path.join(ROOT, "Server-TCP.py")
+CLIENT_PATH = os.path.join(ROOT, "Client-TCP.py")
+sys.path.insert(0, ROOT)  # the client imports client_common from next to it
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_server():
+    return load_module("server_tcp", SERVER_PATH)
+
+
+server_tcp = load_server()
+
+
+class TextRangeTest(unittest.TestCase):
+    """Text protocol range requests: "filename offset length"."""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.data = bytes(range(256)) * 40
+        with open(os.path.join(self.folder.name, "big.bin"), "wb") as f:
+            f.write(self.data)
+        list_path = os.path.join(self.folder.name, "file_list.txt")
+        with open(list_path, "w") as f:
+            f.write("big.bin 10KB\n")
+        self.catalog = server_tcp.catalog
+        server_tcp.catalog = server_tcp.FileCatalog(self.folder.name, list_path)
+
+    def tearDown(self):
+        server_tcp.catalog = self.catalog
+        self.folder.cleanup()
+
+    def range_response(self, request):
+        responses = server_tcp.handle_request(request, ("127.0.0.1", 0))
+        self.assertIsInstance(responses[-1], server_tcp.RequestDone)
+        return responses[0]
+
+    def test_valid_range(self):
+        response = self.range_response("big.bin 100 50")
+        self.assertIsInstance(response, server_tcp.FileRange)
+        self.assertEqual((response.offset, response.length), (100, 50))
+
+    def test_range_clamped_to_end_of_file(self):
+        response = self.range_response(f"big.bin {len(self.data) - 10} 100")
+        self.assertEqual(response.length, 10)
+
+    def test_negative_offset(self):
+        self.assertEqual(self.range_response("big.bin -5 10"), b"Error: Negative offset or length")
+
+    def test_negative_length(self):
+        self.assertEqual(self.range_response("big.bin 5 -10"), b"Error: Negative offset or length")
+
+    def test_offset_past_end_of_file(self):
+        response = self.range_response(f"big.bin {len(self.data) + 1} 10")
+        self.assertTrue(response.startswith(b"Error: Offset"))
+
+    def test_ranges_start_with_length_table(self):
+        end = len(self.data)
+        responses = server_tcp.handle_request(f"RANGES big.bin 0:10 10:5 {end - 4}:100", ("127.0.0.1", 0))
+        table, ranges = responses[0], responses[1]
+        self.assertEqual(table, b"".join(server_tcp.RANGE_LENGTH.pack(n) for n in (10, 5, 4)))
+        self.assertEqual(ranges.ranges, [(0, 15), (end - 4, 4)])
+
+    def test_ranges_offset_past_end_of_file(self):
+        response = self.range_response(f"RANGES big.bin 0:10 {len(self.data) + 1}:10")
+        self.assertTrue(response.startswith(b"Error: Offset"))
+
+    def test_file_named_like_a_command(self):
+        with open(os.path.join(self.folder.name, "RANGES"), "wb") as f:
+            f.write(self.data)
+        response = self.range_response("RANGES 10 20")
+        self.assertEqual((response.offset, response.length), (10, 20))
+        self.assertTrue(self.range_response("STATS").startswith(b"{"))
+        with open(os.path.join(self.folder.name, "STATS"), "wb") as f:
+            f.write(self.data)
+        self.assertEqual(self.range_response("STATS"), str(len(self.data)).encode())
+
+    def test_connection_survives_invalid_range(self):
+        server_side, client_side = socket.socketpair()
+        thread = threading.Thread(target=server_tcp.process_client, args=(server_side, ("127.0.0.1", 0)))
+        thread.start()
+        try:
+            client_side.settimeout(5)
+            self.assertEqual(client_side.recv(1024), b"big.bin 10KB")
+            client_side.sendall(b"big.bin -5 10")
+            self.assertTrue(client_side.recv(1024).startswith(b"Error:"))
+            client_side.sendall(b"big.bin 10 20")
+            received = b""
+            while len(received) < 20:
+                received += client_side.recv(1024)
+            self.assertEqual(received, self.data[10:30])
+        finally:
+            client_side.close()
+            thread.join(5)
+
+
+class CompressedRangeTest(unittest.TestCase):
+    """Framed ZRANGE requests, answered block by block."""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        block = server_tcp.COMPRESS_BLOCK
+        self.files = {
+            "text.log": b"".join(b"log line %d\n" % i for i in range(3 * block // 12)),
+            "random.bin": os.urandom(2 * block + 1000),
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.folder.name, name), "wb") as f:
+                f.write(data)
+        list_path = os.path.join(self.folder.name, "file_list.txt")
+        with open(list_path, "w") as f:
+            f.write("text.log\nrandom.bin\n")
+        self.catalog, self.block_cache = server_tcp.catalog, server_tcp.block_cache
+        server_tcp.catalog = server_tcp.FileCatalog(self.folder.name, list_path)
+        server_tcp.block_cache = server_tcp.BlockCache()
+        self.session = server_tcp.Session(("127.0.0.1", 0))
+        server_tcp.run_frame(server_tcp.OP_HELLO, 1, b"zlib", self.session)
+
+    def tearDown(self):
+        server_tcp.catalog, server_tcp.block_cache = self.catalog, self.block_cache
+        self.folder.cleanup()
+
+    def zrange(self, name, offset, length):
+        """Data of a ZRANGE response and the method of each of its blocks."""
+        payload = server_tcp.RANGE_REQUEST.pack(offset, length) + name.encode()
+        responses = server_tcp.handle_frame(server_tcp.OP_ZRANGE, 2, payload, self.session)
+        data = b""
+        methods = []
+        header_size = server_tcp.FRAME_HEADER.size + server_tcp.BLOCK_HEADER.size
+        for item in responses[0]:
+            if isinstance(item, server_tcp.FileRange):
+                with open(item.path, "rb") as f:
+                    f.seek(item.offset)
+                    data += f.read(item.length)
+                continue
+            block_offset, raw_len, method = server_tcp.BLOCK_HEADER.unpack_from(item, server_tcp.FRAME_HEADER.size)
+            self.assertEqual(block_offset, offset + len(data))
+            methods.append(method)
+            if method == server_tcp.BLOCK_COMPRESSED:
+                block = zlib.decompress(item[header_size:])
+                self.assertEqual(len(block), raw_len)
+                data += block
+        return data, methods
+
+    def test_round_trip(self):
+        data = self.files["text.log"]
+        offset, length = 1000, 2 * server_tcp.COMPRESS_BLOCK
+        received, methods = self.zrange("text.log", offset, length)
+        self.assertEqual(received, data[offset:offset + length])
+        self.assertEqual(methods, [server_tcp.BLOCK_COMPRESSED] * 3)
+
+    def test_incompressible_file_sent_stored(self):
+        data = self.files["random.bin"]
+        received, methods = self.zrange("random.bin", 0, len(data))
+        self.assertEqual(received, data)
+        self.assertEqual(methods, [server_tcp.BLOCK_STORED] * 3)
+
+    def test_block_cache_bound(self):
+        cache = server_tcp.BlockCache(max_bytes=2 * server_tcp.BLOCK_ENTRY_COST)
+        entry = server_tcp.catalog.get("random.bin")
+        for index in range(3):
+            self.assertIsNone(cache.get(entry, index, "zlib"))
+        # Blocks that don't compress are cached as None, and still count toward the limit
+        self.assertEqual(len(cache.blocks), 2)
+        self.assertEqual(cache.size, 2 * server_tcp.BLOCK_ENTRY_COST)
+
+
+class ConcurrentDownloadTest(unittest.TestCase):
+    """Several files downloaded at once by the client, from both server engines."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = load_module("client_tcp", CLIENT_PATH)
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.files = {
+            "big.bin": os.urandom(9 * 1024 * 1024),
+            "text.log": b"".join(b"log line %d\n" % i for i in range(200000)),
+            "small.bin": os.urandom(3000),
+            "tiny.txt": b"hello\n",
+        }
+        for name, data in cls.files.items():
+            with open(os.path.join(cls.folder.name, name), "wb") as f:
+                f.write(data)
+        cls.list_path = os.path.join(cls.folder.name, "file_list.txt")
+        with open(cls.list_path, "w") as f:
+            f.write("".join(f"{name}\n" for name in cls.files))
+        cls.ports = {mode: cls.start_server(mode) for mode in ("threaded", "selectors")}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folder.cleanup()
+
+    @classmethod
+    def start_server(cls, mode):
+        """Run an engine in a daemon thread, on its own copy of the module. Returns its port."""
+        server = load_module(f"server_tcp_{mode}", SERVER_PATH)
+        server.catalog = server.FileCatalog(cls.folder.name, cls.list_path)
+        server.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.server.bind(("127.0.0.1", 0))
+        server.server.listen()  # before the engine thread runs, so the first connect isn't refused
+        engine = server.start_event_server if mode == "selectors" else server.start_server
+        threading.Thread(target=engine, daemon=True).start()
+        return server.server.getsockname()[1]
+
+    def download(self, mode, **options):
+        with tempfile.TemporaryDirectory() as dest:
+            client = self.client.Downloader("127.0.0.1", self.ports[mode], progress="none", **options)
+            try:
+                stats = client.download(list(self.files), dest)
+            finally:
+                client.close()
+            for name, data in self.files.items():
+                self.assertEqual(stats[name]["status"], "downloaded", name)
+                with open(os.path.join(dest, name), "rb") as f:
+                    self.assertEqual(f.read(), data, name)
+
+    def test_threaded(self):
+        self.download("threaded")
+
+    def test_selectors(self):
+        self.download("selectors")
+
+    def test_threaded_compressed(self):
+        self.download("threaded", compress=True)
+
+    def test_selectors_compressed(self):
+        self.download("selectors", compress=True)
+
+    def test_text_protocol(self):
+        self.download("selectors", framing=False)
+
+
+if __name__ == "__main__":
+    unittest.main()